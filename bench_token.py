@@ -0,0 +1,84 @@
+"""
+bench_token.py : Compare token issue and verify throughput per signing algorithm
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import time
+import timeit
+import uuid
+
+import jwt
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
+
+def get_keys(rsa_bits):
+    """Generate one private key per algorithm"""
+    return {
+        'RS512': rsa.generate_private_key(public_exponent=65537, key_size=rsa_bits, backend=default_backend()),
+        'ES256': ec.generate_private_key(ec.SECP256R1(), backend=default_backend()),
+        'EdDSA': ed25519.Ed25519PrivateKey.generate(),
+    }
+
+
+def get_claims():
+    """Same shape as the tokens issued by Agent.get_token"""
+    now = int(time.time())
+    return {
+        'nbf': now,
+        'iat': now,
+        'exp': now + 12 * 3600,
+        'iss': 'auth_module',
+        'aud': ['agent', 'urn:router', 'urn:code', 'urn:task', 'urn:data'],
+        'sub': str(uuid.uuid4()),
+        'aid': uuid.uuid4().hex,
+    }
+
+
+def bench(algorithm, privkey, count):
+    pubkey = privkey.public_key()
+    claims = get_claims()
+    token = jwt.encode(claims, privkey, algorithm=algorithm, headers=dict(kid='bench'))
+
+    issue = timeit.timeit(lambda: jwt.encode(claims, privkey, algorithm=algorithm, headers=dict(kid='bench')),
+                          number=count)
+    verify = timeit.timeit(lambda: jwt.decode(token, pubkey, algorithms=[algorithm],
+                                              issuer='auth_module', options=dict(verify_aud=False)),
+                           number=count)
+    return len(token), count / issue, count / verify
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--count', type=int, default=1000, help="operations per measure")
+    parser.add_argument('--rsa-bits', type=int, default=2048, help="RSA key size")
+    args = parser.parse_args()
+
+    print("{:<8} {:>10} {:>12} {:>12}".format('alg', 'size (B)', 'issue/s', 'verify/s'))
+    for algorithm, privkey in get_keys(args.rsa_bits).items():
+        try:
+            size, issue, verify = bench(algorithm, privkey, args.count)
+        except (NotImplementedError, jwt.exceptions.PyJWTError) as exc:
+            print("{:<8} unavailable: {}".format(algorithm, exc))
+            continue
+        print("{:<8} {:>10} {:>12.0f} {:>12.0f}".format(algorithm, size, issue, verify))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +0,0 @@
-from .app import app
-
-__all__ = ['app']
@@ -28,6 +28,8 @@ from flask import current_app as app
 from epmanage import settings
 from epmanage.lib.app import App
 from epmanage.lib.auth import auth_required, AuthController, AuthException
+from epmanage.lib.catalog import TaskCatalog, APPS_KEY
+from epmanage.lib.passwords import PasswordHasher
 from epmanage.utils import cors
 
 admin_component = Blueprint('admin_component', __name__)
@@ -52,6 +54,13 @@ def admin_invite():
         abort(406)
 
 
+@admin_component.route('/metrics', methods=['GET', 'OPTIONS'])
+@auth_required('urn:cmi_superadmin')
+@cors()
+def admin_metrics():
+    return jsonify(passwords=PasswordHasher().get_stats())
+
+
 @admin_component.route('/apps', methods=['GET', 'OPTIONS'])
 @auth_required('urn:cmi_superadmin')
 @cors()
@@ -85,6 +94,7 @@ def admin_apps_do(app_name):
     app_db = app.data.pymongo('app').db['app']
     if action == 'disable':
         app_db.remove(dict(name=app_name))
+        TaskCatalog().bump(APPS_KEY)
         return Response(status=204)
     elif action == 'enable':
         schema = settings.config.DOMAIN['app']['schema']
@@ -118,6 +128,7 @@ def admin_apps_do(app_name):
             app_item.prepare_data()
 
             app_item.save()
+            TaskCatalog().bump(APPS_KEY)
         return Response(status=201)
     else:
         abort(404, 'Invalid action')
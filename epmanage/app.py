@@ -24,14 +24,19 @@ import os
 from logging.handlers import RotatingFileHandler
 
 from eve import Eve
-from flask import Response
+from flask import Response, g, request
 from raven.contrib.flask import Sentry
 from werkzeug.contrib.fixers import ProxyFix
 from werkzeug.utils import import_string
 
 import epmanage.settings as settings
+from epmanage.lib.agent import Agent
+from epmanage.lib.app import App
 from epmanage.lib.auth import JWTAuth, AuthController
+from epmanage.lib.catalog import TaskCatalog
 from epmanage.lib.filter import Filter
+from epmanage.lib.membership import FilterMembership
+from epmanage.lib.seats import SeatCounter
 from epmanage.lib.user import User
 from epmanage.reverseproxied import ReverseProxied
 from epmanage.utils import Mongo, CustomValidator
@@ -73,6 +78,29 @@ class EPManageEve(Eve):
 
             self.on_delete_item_user += User.eve_hook_anti_self_delete_user
 
+            # Licensed seats
+            self.on_inserted_user += SeatCounter.eve_hook_inserted_user
+            self.on_updated_user += SeatCounter.eve_hook_updated_user
+            self.on_replaced_user += SeatCounter.eve_hook_updated_user
+            self.on_deleted_item_user += SeatCounter.eve_hook_deleted_user
+
+        if 'agent' in self.config['DOMAIN'].keys():
+            # Cached agent tokens hold a snapshot of the agent
+            self.on_updated_agent += Agent.eve_hook_evict_agent
+            self.on_replaced_agent += Agent.eve_hook_evict_agent
+            self.on_deleted_item_agent += Agent.eve_hook_evict_agent
+
+            # Licensed seats
+            self.on_inserted_agent += SeatCounter.eve_hook_inserted_agent
+            self.on_updated_agent += SeatCounter.eve_hook_updated_agent
+            self.on_replaced_agent += SeatCounter.eve_hook_updated_agent
+            self.on_deleted_item_agent += SeatCounter.eve_hook_deleted_agent
+
+            # Filter membership
+            self.on_insert_agent += FilterMembership.eve_hook_insert_agent
+            self.on_update_agent += FilterMembership.eve_hook_update_agent
+            self.on_replace_agent += FilterMembership.eve_hook_replace_agent
+
         if 'filter' in self.config['DOMAIN'].keys():
             # Fixups for EVE API endpoints
             self.on_insert_filter += Filter.eve_hook_write_filter
@@ -80,6 +108,33 @@ class EPManageEve(Eve):
             self.on_update_filter += Filter.eve_hook_write_filter
             self.on_delete_item_filter += Filter.eve_hook_write_filter
 
+            # Task catalog snapshots and filter membership (refreshed in the background)
+            self.on_inserted_filter += TaskCatalog.eve_hook_bump_filters
+            self.on_updated_filter += TaskCatalog.eve_hook_bump_filters
+            self.on_replaced_filter += TaskCatalog.eve_hook_bump_filters
+            self.on_deleted_item_filter += TaskCatalog.eve_hook_bump_filters
+
+        if 'action' in self.config['DOMAIN'].keys():
+            self.on_inserted_action += TaskCatalog.eve_hook_bump
+            self.on_updated_action += TaskCatalog.eve_hook_bump
+            self.on_replaced_action += TaskCatalog.eve_hook_bump
+            self.on_deleted_item_action += TaskCatalog.eve_hook_bump
+
+        if 'config' in self.config['DOMAIN'].keys():
+            # Parsed configs, stored on write
+            self.on_insert_config += App.eve_hook_insert_config
+            self.on_update_config += App.eve_hook_update_config
+            self.on_replace_config += App.eve_hook_replace_config
+            self.on_inserted_config += App.eve_hook_refresh_configs
+            self.on_updated_config += App.eve_hook_refresh_configs
+            self.on_replaced_config += App.eve_hook_refresh_configs
+            self.on_deleted_item_config += App.eve_hook_refresh_configs
+
+            self.on_inserted_config += TaskCatalog.eve_hook_bump
+            self.on_updated_config += TaskCatalog.eve_hook_bump
+            self.on_replaced_config += TaskCatalog.eve_hook_bump
+            self.on_deleted_item_config += TaskCatalog.eve_hook_bump
+
     def load_config(self):
         """Override default load_config"""
         conf_module = os.environ.get('EPMANAGE_CONFIG_MODULE')
@@ -106,6 +161,11 @@ class EPManageSentry(Sentry):
 
 app = EPManageEve(auth=JWTAuth, data=Mongo, validator=CustomValidator)
 
+if settings.config.SEATS_RECONCILE_INTERVAL:
+    SeatCounter.schedule_reconcile(app, settings.config.SEATS_RECONCILE_INTERVAL)
+
+FilterMembership.schedule_refresh(app, settings.config.MEMBERSHIP_REFRESH_INTERVAL)
+
 if not settings.config.DEBUG:
     sentry = EPManageSentry(app, register_signal=False, logging=True, level=logging.WARNING)
 else:
@@ -124,6 +184,11 @@ def after(response):
     """Remove cache control when request failed"""
     if response.status_code not in range(200, 300):
         response.cache_control.max_age = 0
+    if settings.config.DEBUG:
+        token_decodes = getattr(g, 'token_decodes', 0)
+        response.headers['X-Token-Decodes'] = str(token_decodes)
+        if token_decodes > 1:
+            logging.warning("Token decoded %d times for %s", token_decodes, request.path)
     return response
 
 
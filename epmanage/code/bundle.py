@@ -0,0 +1,263 @@
+"""
+bundle.py : Deploy-time builder for manifest and package bundles
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Usage: python -m epmanage.code.bundle [--arch win_x64] [--compress] [--keep 3]
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import List
+
+from pymongo import MongoClient
+from werkzeug.utils import import_string
+
+import epmanage.settings as settings
+from epmanage.code.delta import can_diff, is_worth, diff_file
+from epmanage.code.manifest import COMPATIBILITY_OSES, COMPATIBILITY_OSTYPES, is_compatible, \
+    get_manifest_paths, build_manifest, get_package_roots, index_packages, get_platform_key
+from epmanage.lib.package import get_encodings, compress_file, file_sha256
+
+logger = logging.getLogger(__name__)
+
+
+class BundleBuilder(object):
+    """Build the bundle of an arch in BUNDLE_PATH/<arch>/<id> and make it current"""
+
+    def __init__(self, bundle_path: str, compress=False, history=0):
+        self.bundle_path = bundle_path
+        self.objects = os.path.join(bundle_path, 'objects')
+        self.compress = compress
+        self.history = history
+        os.makedirs(self.objects, exist_ok=True)
+
+    def __store(self, digest: str, write):
+        """Store an object once, write(path) creates its content"""
+        path = os.path.join(self.objects, digest)
+        if not os.path.exists(path):
+            fd, tmp_path = tempfile.mkstemp(dir=self.objects)
+            os.close(fd)
+            write(tmp_path)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        return digest
+
+    def store_bytes(self, data: bytes) -> str:
+        def write(path):
+            with open(path, 'wb') as ofile:
+                ofile.write(data)
+        return self.__store(hashlib.sha256(data).hexdigest(), write)
+
+    def store_file(self, src: str) -> str:
+        return self.__store(file_sha256(src), lambda path: shutil.copyfile(src, path))
+
+    def store_variants(self, src: str) -> dict:
+        """Store the precompressed variants of a package, those smaller than the package"""
+        variants = dict()
+        if not self.compress:
+            return variants
+        for encoding in get_encodings():
+            fd, tmp_path = tempfile.mkstemp(dir=self.objects)
+            os.close(fd)
+            try:
+                compress_file(encoding, src, tmp_path)
+                size = os.path.getsize(tmp_path)
+                if size < os.path.getsize(src):
+                    variants[encoding] = dict(object=self.store_file(tmp_path), size=size)
+            finally:
+                os.remove(tmp_path)
+        return variants
+
+    def store_deltas(self, src: str, history: List[str], previous: dict) -> dict:
+        """Store the patches from the prior versions of a package, those worth sending"""
+        deltas = dict()
+        size = os.path.getsize(src)
+        if not can_diff(size):
+            return deltas
+        for digest in history:
+            # Already made for the previous bundle when the package did not change
+            delta = previous.get(digest)
+            if delta and os.path.exists(os.path.join(self.objects, delta['object'])):
+                deltas[digest] = delta
+                continue
+            fd, tmp_path = tempfile.mkstemp(dir=self.objects)
+            os.close(fd)
+            try:
+                diff_file(os.path.join(self.objects, digest), src, tmp_path)
+                delta_size = os.path.getsize(tmp_path)
+                if is_worth(delta_size, size):
+                    deltas[digest] = dict(object=self.store_file(tmp_path), size=delta_size)
+            finally:
+                os.remove(tmp_path)
+        return deltas
+
+    @staticmethod
+    def get_packages(arch_path: str) -> dict:
+        """Get the packages of the current bundle of an arch"""
+        try:
+            with open(os.path.join(arch_path, 'current', 'bundle.json')) as ifile:
+                return json.load(ifile)['packages']
+        except (OSError, ValueError):
+            return dict()
+
+    def build(self, arch: str, apps: List[dict]) -> str:
+        """Build the bundle of an arch, returns its id"""
+        manifests = dict()
+        for osname in COMPATIBILITY_OSES + [None]:
+            for ostype in COMPATIBILITY_OSTYPES + [None]:
+                platform = (osname, ostype)
+                app_names = sorted(item['name'] for item in apps if is_compatible(item, platform))
+                data = build_manifest(get_manifest_paths(arch, app_names))
+                manifests[get_platform_key(platform)] = self.store_bytes(data)
+
+        arch_path = os.path.join(self.bundle_path, arch)
+        previous = self.get_packages(arch_path)
+        packages = dict()
+        for pkg, path in index_packages(get_package_roots(arch)).items():
+            packages[pkg] = dict(object=self.store_file(path), size=os.path.getsize(path),
+                                 variants=self.store_variants(path))
+            # Prior versions, the sources of the deltas
+            item = previous.get(pkg)
+            if self.history and item:
+                history = [digest for digest in dict.fromkeys([item['object']] + item.get('history', []))
+                           if digest != packages[pkg]['object']][:self.history]
+                if history:
+                    packages[pkg]['history'] = history
+                    same = item['object'] == packages[pkg]['object']
+                    deltas = self.store_deltas(path, history, item.get('deltas', {}) if same else {})
+                    if deltas:
+                        packages[pkg]['deltas'] = deltas
+
+        content = json.dumps(dict(manifests=manifests, packages=packages), sort_keys=True).encode()
+        bundle_id = '{}-{}'.format(time.strftime('%Y%m%d%H%M%S'), hashlib.sha256(content).hexdigest()[:12])
+        os.makedirs(arch_path, exist_ok=True)
+
+        tmp_path = tempfile.mkdtemp(dir=arch_path, prefix='.build-')
+        with open(os.path.join(tmp_path, 'bundle.json'), 'w') as ofile:
+            json.dump(dict(id=bundle_id, arch=arch, manifests=manifests, packages=packages), ofile,
+                      sort_keys=True)
+        os.chmod(tmp_path, 0o755)
+        os.rename(tmp_path, os.path.join(arch_path, bundle_id))
+
+        # Atomic swap of the current bundle
+        link_path = os.path.join(arch_path, '.current-{}'.format(bundle_id))
+        os.symlink(bundle_id, link_path)
+        os.replace(link_path, os.path.join(arch_path, 'current'))
+        logger.info("Bundle %s for %s: %d packages", bundle_id, arch, len(packages))
+        return bundle_id
+
+    def prune(self, keep: int):
+        """Remove the old bundles and the objects they alone use"""
+        referenced = set()
+        for arch in os.listdir(self.bundle_path):
+            arch_path = os.path.join(self.bundle_path, arch)
+            if arch == 'objects' or not os.path.isdir(arch_path):
+                continue
+            try:
+                current = os.readlink(os.path.join(arch_path, 'current'))
+            except OSError:
+                current = None
+            bundles = sorted((name for name in os.listdir(arch_path)
+                              if not name.startswith('.') and name != 'current'), reverse=True)
+            kept = bundles[:keep]
+            if current and current not in kept:
+                kept.append(current)
+            for name in bundles:
+                if name not in kept:
+                    shutil.rmtree(os.path.join(arch_path, name))
+            for name in kept:
+                with open(os.path.join(arch_path, name, 'bundle.json')) as ifile:
+                    data = json.load(ifile)
+                referenced.update(data['manifests'].values())
+                for item in data['packages'].values():
+                    referenced.add(item['object'])
+                    referenced.update(item.get('history', []))
+                    referenced.update(delta['object'] for delta in item.get('deltas', {}).values())
+                    referenced.update(variant['object'] for variant in item.get('variants', {}).values())
+
+        for name in os.listdir(self.objects):
+            if name not in referenced:
+                os.remove(os.path.join(self.objects, name))
+
+
+def get_apps(config) -> List[dict]:
+    """Read the apps from the global database"""
+    if config.get('MONGO_URI'):
+        client = MongoClient(config['MONGO_URI'])
+        database = client.get_default_database()
+    else:
+        options = dict()
+        if config.get('MONGO_USERNAME'):
+            options.update(username=config['MONGO_USERNAME'], password=config.get('MONGO_PASSWORD'))
+            if config.get('MONGO_AUTH_SOURCE'):
+                options['authSource'] = config['MONGO_AUTH_SOURCE']
+        if config.get('MONGO_REPLICA_SET'):
+            options['replicaset'] = config['MONGO_REPLICA_SET']
+        client = MongoClient(host=config['MONGO_HOST'], port=config['MONGO_PORT'], **options)
+        database = client[config['MONGO_DBNAME']]
+    try:
+        return list(database['app'].find({}, {'name': True, 'compatibility': True}))
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the manifest and package bundles")
+    parser.add_argument('--arch', action='append', help="Arch folder of BIN_PATH, all of them by default")
+    parser.add_argument('--output', help="Bundle folder, BUNDLE_PATH by default")
+    parser.add_argument('--compress', action='store_true', help="Add the gzip and zstd (if installed) package variants")
+    parser.add_argument('--keep', type=int, default=3, help="Bundles kept per arch")
+    parser.add_argument('--history', type=int, help="Prior package versions the deltas are made from, "
+                                                    "PACKAGE_DELTA_HISTORY by default")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Same settings as the application, without creating it
+    config = import_string(os.environ.get('EPMANAGE_CONFIG_MODULE') or 'epmanage.settings.Config')()
+    settings.config = config
+    bundle_path = args.output or config.get('BUNDLE_PATH')
+    if not bundle_path:
+        parser.error("No bundle folder, set BUNDLE_PATH or --output")
+    arches = args.arch or sorted(name for name in os.listdir(config['BIN_PATH'])
+                                 if os.path.isdir(os.path.join(config['BIN_PATH'], name)))
+
+    apps = get_apps(config)
+
+    history = args.history if args.history is not None else config['PACKAGE_DELTA_HISTORY']
+    builder = BundleBuilder(bundle_path, args.compress, history)
+    failed = False
+    for arch in arches:
+        try:
+            builder.build(arch, apps)
+        except FileNotFoundError as exc:
+            logger.error("Cannot build the bundle for %s: %s", arch, exc)
+            failed = True
+    builder.prune(args.keep)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -18,10 +18,11 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
-from flask import Blueprint, request, abort, Response
+from flask import Blueprint, request, abort, Response, jsonify
 
-from epmanage.code.manifest import ManifestController
+from epmanage.code.manifest import ManifestController, COMPATIBILITY_OSES, COMPATIBILITY_OSTYPES
 from epmanage.lib.auth import auth_required, current_identity
+from epmanage.lib.package import Package, send_package
 
 code_component = Blueprint('code_component', __name__)
 
@@ -40,39 +41,83 @@ def get_arch_folder():
         return 'unk'
 
 
+# Agent os to the os names of the app compatibility
+COMPATIBILITY_OS = {
+    'win32': 'windows',
+    'android': 'android',
+}
+
+
+def get_platform():
+    """Get the (os, ostype) of the agent as in the app compatibility, None when unknown"""
+    agent = current_identity
+
+    osname = COMPATIBILITY_OS.get(agent['os'])
+    if agent['os'] == 'unix':
+        osname = {'darwin': 'macosx'}.get(agent['osversion'], agent['osversion'])
+    if osname not in COMPATIBILITY_OSES:
+        osname = None
+    ostype = agent['ostype'] if agent['ostype'] in COMPATIBILITY_OSTYPES else None
+    return osname, ostype
+
+
+PACKAGE_MAX_AGE = 3600 * 24 * 30
+
+
 @code_component.route('/pkg', methods=['GET'])
 @auth_required('urn:code')
 def code_get():
-    """Get some code"""
+    """Get some code
+
+    With ?from=<sha256> of the version held by the agent, a bsdiff4 patch to the current
+    version is sent when one is already made (X-Delta-From is set), the full package otherwise.
+    """
     pkg = request.args.get('id')
     if not pkg:
         abort(404)
     mmanager = ManifestController(get_arch_folder())
 
-    data = mmanager.get_pkg(pkg)
-    if not data:
+    package = mmanager.get_package(pkg)
+    if not package:
         abort(404)
-    resp = Response(response=data,
-                    status=200,
-                    mimetype="application/epccode")
-    resp.cache_control.max_age = 3600 * 24 * 30
-    return resp
+
+    source = request.args.get('from')
+    if source and source != package.etag:
+        delta = mmanager.get_delta(pkg, package, source)
+        if delta:
+            patch = Package(delta.path, delta.size, '{}-{}'.format(source, package.etag))
+            resp = send_package(patch, "application/epcdelta", PACKAGE_MAX_AGE, compress=False)
+            resp.headers['X-Delta-From'] = source
+            resp.headers['X-Delta-To'] = package.etag
+            return resp
+    return send_package(package, "application/epccode", PACKAGE_MAX_AGE)
 
 
 @code_component.route('/manifest', methods=['GET'])
 @auth_required('urn:code')
 def code_get_manifest():
-    mmanager = ManifestController(get_arch_folder())
+    mmanager = ManifestController(get_arch_folder(), get_platform())
+    manifest = mmanager.get_manifest()
 
     try:
-        cur = int(request.args.get('cur'))
-        if cur > 0 and cur == mmanager.get_timestamp():
-            return Response(status=304)
+        cur = int(request.args.get('cur', 0))
     except ValueError:
         abort(404)
-
-    resp = Response(response=mmanager.get_data(),
-                    status=200,
-                    mimetype="application/epmanifest")
-    resp.cache_control.max_age = 300
+    if (cur > 0 and cur == manifest.version) or manifest.etag in request.if_none_match:
+        resp = Response(status=304)
+    else:
+        resp = Response(response=manifest.data,
+                        status=200,
+                        mimetype="application/epmanifest")
+        resp.cache_control.max_age = 300
+    resp.set_etag(manifest.etag)
+    resp.headers['X-Manifest-Version'] = str(manifest.version)
     return resp
+
+
+@code_component.route('/manifest/deltas', methods=['GET'])
+@auth_required('urn:code')
+def code_get_deltas():
+    """List the packages with their current sha256 and the sha256 deltas can be requested from"""
+    mmanager = ManifestController(get_arch_folder())
+    return jsonify(mmanager.get_deltas())
@@ -0,0 +1,187 @@
+"""
+delta.py : Binary deltas between code package versions
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import os
+import shutil
+import tempfile
+from typing import Optional, List
+from urllib.parse import quote, unquote
+
+import epmanage.settings as settings
+from epmanage.lib.package import Variant, PackageJobs
+from epmanage.utils import Singleton
+
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
+logger = logging.getLogger(__name__)
+
+
+def is_enabled() -> bool:
+    """Deltas need the bsdiff4 package and a delta folder"""
+    return bool(bsdiff4 and settings.config.PACKAGE_DELTA_PATH)
+
+
+def can_diff(size: int) -> bool:
+    """Check if deltas are made to a package of this size"""
+    return bool(bsdiff4) and size <= settings.config.PACKAGE_DELTA_MAX_SIZE
+
+
+def is_worth(size: int, package_size: int) -> bool:
+    """Check if a delta of this size is sent instead of the package"""
+    return size < package_size * settings.config.PACKAGE_DELTA_MAX_RATIO
+
+
+def diff_file(source_path: str, path: str, dst: str):
+    """Write the bsdiff4 patch from source_path to path in dst"""
+    bsdiff4.file_diff(source_path, path, dst)
+
+
+class PackageHistory(metaclass=Singleton):
+    """Prior versions of the packages served without a bundle
+
+    Each version of a package is copied once to PACKAGE_HISTORY_PATH/<arch>/<pkg>/<sha256>
+    in the background when it is first served, the PACKAGE_DELTA_HISTORY most recent ones
+    are kept. The deltas from the prior versions are queued at the same time.
+    """
+
+    def __init__(self):
+        self.__known = set()  # (arch, pkg, etag) already archived by this process
+
+    @staticmethod
+    def __folder(arch: str, pkg: str) -> str:
+        return os.path.join(settings.config.PACKAGE_HISTORY_PATH, arch, quote(pkg, safe=''))
+
+    def queue(self, arch: str, pkg: str, package):
+        """Archive the current version of a package in the background"""
+        if is_enabled() and (arch, pkg, package.etag) not in self.__known:
+            PackageJobs().submit(('archive', arch, pkg, package.etag), self.archive, arch, pkg, package)
+
+    def archive(self, arch: str, pkg: str, package):
+        """Keep a copy of the current version of a package"""
+        if not is_enabled() or (arch, pkg, package.etag) in self.__known:
+            return
+        folder = self.__folder(arch, pkg)
+        path = os.path.join(folder, package.etag)
+        try:
+            if not os.path.exists(path):
+                os.makedirs(folder, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.')
+                os.close(fd)
+                shutil.copyfile(package.path, tmp_path)
+                os.replace(tmp_path, path)
+            versions = sorted((entry for entry in os.scandir(folder) if not entry.name.startswith('.')),
+                              key=lambda entry: entry.stat().st_mtime, reverse=True)
+            for entry in versions[settings.config.PACKAGE_DELTA_HISTORY + 1:]:
+                os.remove(entry.path)
+        except OSError:
+            logger.exception("Cannot archive %s", package.path)
+            return
+        self.__known.add((arch, pkg, package.etag))
+        for source in self.get(arch, pkg, package.etag):
+            DeltaCache().get(source, package)
+
+    def get(self, arch: str, pkg: str, etag: str) -> List[tuple]:
+        """Get the prior (etag, path) of a package, most recent first"""
+        if not is_enabled():
+            return []
+        try:
+            versions = sorted((entry for entry in os.scandir(self.__folder(arch, pkg))
+                               if not entry.name.startswith('.') and entry.name != etag),
+                              key=lambda entry: entry.stat().st_mtime, reverse=True)
+        except OSError:
+            return []
+        return [(entry.name, entry.path) for entry in versions[:settings.config.PACKAGE_DELTA_HISTORY]]
+
+    def get_packages(self, arch: str) -> List[str]:
+        """Get the ids of the packages with prior versions"""
+        try:
+            return [unquote(name) for name in os.listdir(os.path.join(settings.config.PACKAGE_HISTORY_PATH, arch))]
+        except OSError:
+            return []
+
+
+class DeltaCache(metaclass=Singleton):
+    """bsdiff4 patches between two package versions, made in the background
+
+    Patches are named <from>-<to> in PACKAGE_DELTA_PATH. A missing patch is queued and the
+    full package is sent until it exists. When the folder grows over
+    PACKAGE_DELTA_CACHE_SIZE bytes, the least recently served patches are removed.
+    Patches not smaller than PACKAGE_DELTA_MAX_RATIO of the package are not served.
+    """
+
+    @staticmethod
+    def __prune():
+        folder = settings.config.PACKAGE_DELTA_PATH
+        entries = sorted((entry for entry in os.scandir(folder) if not entry.name.startswith('.')),
+                         key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= settings.config.PACKAGE_DELTA_CACHE_SIZE:
+                break
+            try:
+                total -= entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def __make(self, source: tuple, package, path: str):
+        source_etag, source_path = source
+        if os.path.exists(path):
+            return
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.')
+        os.close(fd)
+        try:
+            diff_file(source_path, package.path, tmp_path)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except Exception:
+            logger.exception("Cannot make the delta from %s to %s", source_path, package.path)
+            os.remove(tmp_path)
+            return
+        logger.info("Delta from %s to %s: %d bytes", source_etag, package.etag, os.path.getsize(path))
+        self.__prune()
+
+    def get(self, source: tuple, package, serve=True) -> Optional[Variant]:
+        """Get the patch from a (etag, path) source to a package, None if not made yet or not worth it
+
+        With serve, the patch is marked as recently served, or queued when it is missing.
+        """
+        source_etag, _ = source
+        if not is_enabled() or not can_diff(package.size):
+            return None
+        path = os.path.join(settings.config.PACKAGE_DELTA_PATH, '{}-{}'.format(source_etag, package.etag))
+        try:
+            size = os.path.getsize(path)
+            if serve:
+                # The mtime orders the patches for the size budget
+                os.utime(path)
+        except OSError:
+            if serve:
+                PackageJobs().submit(('delta', source_etag, package.etag), self.__make, source, package, path)
+            return None
+        if not is_worth(size, package.size):
+            return None
+        return Variant(path, size)
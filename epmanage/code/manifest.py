@@ -18,78 +18,340 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
+import hashlib
+import json
 import logging
+import os
 import struct
+import threading
+import time
 from pathlib import Path
+from typing import Optional, List
 
-import arrow
 from flask import abort
 from flask import current_app as app
 
 import epmanage.settings as settings
+from epmanage.code.delta import PackageHistory, DeltaCache
+from epmanage.lib.package import Variant, Package, file_sha256
+from epmanage.utils import Singleton
 
+# Values of the app compatibility
+COMPATIBILITY_OSES = ['windows', 'linux', 'macosx', 'android', 'ios']
+COMPATIBILITY_OSTYPES = ['server', 'workstation', 'mobile']
 
-class ManifestController(object):
-    """Manage code manifest"""
 
-    def __init__(self, arch=None):
-        self.arch = arch
-        self.__data = b''
-        self.__timestamp = 0
-        self.__appsdb = app.data.pymongo('app').db['app']
-
-    def get_timestamp(self):
-        """Get the manifest timestamp"""
-        if self.__timestamp == 0:
-            self.get_data()
-        return self.__timestamp
-
-    def __get_manifest_data(self):
-        # Load the codelib manifest
-        data = b''
-        bin_path = Path(settings.config.BIN_PATH, self.arch, 'manifest.bin')
+def is_compatible(app_item: dict, platform: tuple) -> bool:
+    """Check an app compatibility for a (os, ostype) platform, unknown values are compatible"""
+    compatibility = app_item.get('compatibility')
+    if not compatibility:
+        return True
+    osname, ostype = platform
+    if osname and osname not in compatibility.get('os', [osname]):
+        return False
+    if ostype and ostype not in compatibility.get('ostype', [ostype]):
+        return False
+    return True
+
+
+def get_manifest_paths(arch: str, app_names: List[str]) -> List[Path]:
+    """Get the manifest.bin files of a compound manifest, codelib first"""
+    return [Path(settings.config.BIN_PATH, arch, 'manifest.bin')] + \
+           [Path(settings.config.APPS_PATH, name, 'manifest.bin') for name in app_names]
+
+
+def build_manifest(paths: List[Path]) -> bytes:
+    """Build a compound manifest, raises FileNotFoundError without the codelib manifest"""
+    data = [paths[0].read_bytes()]
+
+    # Load apps manifest
+    for app_path in paths[1:]:
         try:
-            data = bin_path.read_bytes()
+            data.append(app_path.read_bytes())
+        except OSError:
+            logging.error("Invalid SPK %s", str(app_path.parent))
+            continue
+
+    return b'SONEMANI' + struct.pack('<H', len(data)) + b''.join(data)
+
+
+def get_package_roots(arch: str) -> List[Path]:
+    """Get the folders holding the packages of an arch, by priority"""
+    apps_path = Path(settings.config.APPS_PATH)
+    apps = sorted(path for path in apps_path.glob('*') if path.is_dir()) if apps_path.is_dir() else []
+    return [Path(settings.config.BIN_PATH, arch)] + apps
+
+
+def index_packages(roots: List[Path]) -> dict:
+    """Map the package ids (path relative to its folder) to the files"""
+    index = dict()
+    for root in roots:
+        for dirpath, _, filenames in os.walk(str(root)):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                pkg = Path(path).relative_to(root).as_posix()
+                index.setdefault(pkg, path)
+    return index
+
+
+class Manifest(object):
+    """Compound manifest of a platform, its version is derived from the content"""
+
+    def __init__(self, key: tuple, data: bytes):
+        self.key = key
+        self.data = data
+        self.etag = hashlib.sha256(data).hexdigest()
+        # Agents send the version back as an integer (cur)
+        self.version = int(self.etag[:15], 16)
+        self.checked = time.monotonic()
+
+
+class ManifestCache(metaclass=Singleton):
+    """Compound manifests per (arch, os, ostype) bucket, with the apps compatible with it
+
+    A manifest is rebuilt when the set of apps or the stat of a manifest.bin changes,
+    checked at most every MANIFEST_CHECK_INTERVAL seconds. Concurrent rebuilds of the
+    same bucket wait for the first one.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__bucket_locks = dict()
+        self.__manifests = dict()
+
+    def __get_bucket_lock(self, bucket):
+        with self.__lock:
+            return self.__bucket_locks.setdefault(bucket, threading.Lock())
+
+    @staticmethod
+    def __stat(path: Path):
+        try:
+            stat = path.stat()
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def __get_key(self, bucket, appsdb):
+        arch, platform = bucket[0], bucket[1:]
+        app_names = sorted(item['name'] for item in appsdb.find({}, {'name': True, 'compatibility': True})
+                           if is_compatible(item, platform))
+        return tuple((str(path), self.__stat(path)) for path in get_manifest_paths(arch, app_names))
+
+    @staticmethod
+    def __build(key: tuple) -> bytes:
+        try:
+            return build_manifest([Path(path) for path, _ in key])
         except FileNotFoundError:
-            logging.error("Cannot find %s", str(bin_path))
+            logging.error("Cannot find %s", key[0][0])
             abort(404)
 
-        manifest_count = 1
+    def get(self, bucket: tuple, appsdb) -> Manifest:
+        """Get the current manifest of an (arch, os, ostype) bucket"""
+        manifest = self.__manifests.get(bucket)
+        if manifest and time.monotonic() - manifest.checked < settings.config.MANIFEST_CHECK_INTERVAL:
+            return manifest
 
-        # Load apps manifest
-        for app_item in self.__appsdb.find():
-            app_path = Path(settings.config.APPS_PATH, app_item['name'])
-            try:
-                app_data = (app_path / 'manifest.bin').read_bytes()
-                data += app_data
-                manifest_count += 1
-            except:
-                logging.error("Invalid SPK %s", str(app_path))
-                continue
+        with self.__get_bucket_lock(bucket):
+            # Another request may have checked it while we were waiting
+            manifest = self.__manifests.get(bucket)
+            if manifest and time.monotonic() - manifest.checked < settings.config.MANIFEST_CHECK_INTERVAL:
+                return manifest
+
+            key = self.__get_key(bucket, appsdb)
+            if manifest and manifest.key == key:
+                manifest.checked = time.monotonic()
+                return manifest
 
-        final_data = b'SONEMANI'
-        final_data += struct.pack('<H', manifest_count)
-        final_data += data
-        return arrow.utcnow().timestamp, final_data
+            manifest = Manifest(key, self.__build(key))
+            self.__manifests[bucket] = manifest
+            return manifest
 
-    def get_data(self):
-        """Returns the compound manifest"""
-        timestamp, data = self.__get_manifest_data()
-        self.__timestamp = timestamp
-        self.__data = data
 
-        return self.__data
+class PackageIndex(metaclass=Singleton):
+    """Package id to file, per arch
 
-    def get_pkg(self, pkg):
-        """Get the pkg code"""
-        binpath = Path(settings.config.BIN_PATH, self.arch)
-        apps_path = Path(settings.config.APPS_PATH)
+    The codelib folder of the arch comes first, then the app folders. The index is built
+    on first use in each process, and built again when a folder mtime changes (checked at
+    most every MANIFEST_CHECK_INTERVAL seconds). Package hashes are kept while the file
+    stat does not change.
+    """
 
-        for path in [binpath] + [x for x in apps_path.glob('*')]:
-            pkg_path = path / pkg
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__indexes = dict()  # arch -> (checked, folders mtimes, {pkg: path})
+        self.__packages = dict()  # path -> Package
+
+    @staticmethod
+    def __get_folders(roots):
+        folders = dict()
+        for root in roots:
+            for dirpath, _, _ in os.walk(str(root)):
+                folders[dirpath] = os.stat(dirpath).st_mtime_ns
+        return folders
+
+    def __get_index(self, arch) -> dict:
+        entry = self.__indexes.get(arch)
+        if entry and time.monotonic() - entry[0] < settings.config.MANIFEST_CHECK_INTERVAL:
+            return entry[2]
+        with self.__lock:
+            roots = get_package_roots(arch)
+            folders = self.__get_folders(roots)
+            if entry and entry[1] == folders:
+                index = entry[2]
+            else:
+                index = index_packages(roots)
+                logging.info("Package index for %s: %d packages", arch, len(index))
+            self.__indexes[arch] = (time.monotonic(), folders, index)
+            return index
+
+    def get(self, arch, pkg) -> Optional[Package]:
+        """Get a package of an arch, None if it does not exist"""
+        path = self.__get_index(arch).get(pkg)
+        if not path:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        package = self.__packages.get(path)
+        if not package or package.stat_key != (stat.st_mtime_ns, stat.st_size):
+            package = Package.from_file(path, stat)
+            self.__packages[path] = package
+            PackageHistory().queue(arch, pkg, package)
+        return package
+
+
+def get_platform_key(platform: tuple) -> str:
+    """Key of a (os, ostype) platform in the bundles, unknown values are empty"""
+    return '{}/{}'.format(platform[0] or '', platform[1] or '')
+
+
+class Bundle(object):
+    """Immutable manifests and package index of an arch, built at deploy time
+
+    Files are stored by sha256 in the objects folder shared by all the bundles.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'bundle.json')) as ifile:
+            self.data = json.load(ifile)
+        self.objects = os.path.join(os.path.dirname(os.path.dirname(path)), 'objects')
+        self.__manifests = dict()
+
+    def get_object(self, digest: str) -> str:
+        return os.path.join(self.objects, digest)
+
+    def get_manifest(self, platform: tuple) -> Optional[Manifest]:
+        key = get_platform_key(platform)
+        manifest = self.__manifests.get(key)
+        if not manifest:
+            digest = self.data['manifests'].get(key)
+            if not digest:
+                return None
+            manifest = Manifest((self.path, key), Path(self.get_object(digest)).read_bytes())
+            self.__manifests[key] = manifest
+        return manifest
+
+    def get_package(self, pkg: str) -> Optional[Package]:
+        item = self.data['packages'].get(pkg)
+        if not item:
+            return None
+        variants = {encoding: Variant(self.get_object(variant['object']), variant['size'])
+                    for encoding, variant in item.get('variants', {}).items()}
+        return Package(self.get_object(item['object']), item['size'], item['object'], variants=variants)
+
+    def get_delta(self, pkg: str, source: str) -> Optional[Variant]:
+        """Get the patch to a package from a prior version, made by the builder"""
+        delta = self.data['packages'].get(pkg, {}).get('deltas', {}).get(source)
+        if not delta:
+            return None
+        return Variant(self.get_object(delta['object']), delta['size'])
+
+
+class BundleStore(metaclass=Singleton):
+    """Current bundle of each arch
+
+    BUNDLE_PATH/<arch>/current is a symlink to the bundle folder, replaced atomically by
+    the builder. It is read again at most every MANIFEST_CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__bundles = dict()  # arch -> (checked, target, Bundle)
+
+    def get(self, arch) -> Optional[Bundle]:
+        """Get the current bundle of an arch, None if there is none"""
+        if not settings.config.BUNDLE_PATH:
+            return None
+        entry = self.__bundles.get(arch)
+        if entry and time.monotonic() - entry[0] < settings.config.MANIFEST_CHECK_INTERVAL:
+            return entry[2]
+        with self.__lock:
             try:
-                if pkg_path.relative_to(path) and pkg_path.exists():
-                    return pkg_path.read_bytes()
-            except:
+                target = os.readlink(os.path.join(settings.config.BUNDLE_PATH, arch, 'current'))
+            except OSError:
+                target = None
+            bundle = entry[2] if entry and entry[1] == target else None
+            if target and not bundle:
+                try:
+                    bundle = Bundle(os.path.join(settings.config.BUNDLE_PATH, arch, target))
+                    logging.info("Serving bundle %s for %s", target, arch)
+                except (OSError, ValueError):
+                    logging.exception("Cannot load bundle %s for %s", target, arch)
+            self.__bundles[arch] = (time.monotonic(), target, bundle)
+            return bundle
+
+
+class ManifestController(object):
+    """Manage code manifest"""
+
+    def __init__(self, arch=None, platform=(None, None)):
+        self.arch = arch
+        self.platform = platform
+        self.__bundle = BundleStore().get(arch)
+
+    def get_manifest(self) -> Manifest:
+        """Get the compound manifest with its version"""
+        if self.__bundle:
+            manifest = self.__bundle.get_manifest(self.platform)
+            if not manifest:
+                abort(404)
+            return manifest
+        appsdb = app.data.pymongo('app').db['app']
+        return ManifestCache().get((self.arch,) + tuple(self.platform), appsdb)
+
+    def get_package(self, pkg) -> Optional[Package]:
+        """Get the pkg code file"""
+        if self.__bundle:
+            return self.__bundle.get_package(pkg)
+        return PackageIndex().get(self.arch, pkg)
+
+    def get_delta(self, pkg, package: Package, source: str) -> Optional[Variant]:
+        """Get the patch to a package from the source version, None if there is none yet"""
+        if self.__bundle:
+            return self.__bundle.get_delta(pkg, source)
+        history = dict(PackageHistory().get(self.arch, pkg, package.etag))
+        if source not in history:
+            return None
+        return DeltaCache().get((source, history[source]), package)
+
+    def get_deltas(self) -> dict:
+        """Get the package ids with their current version and the versions deltas are available from"""
+        deltas = dict()
+        if self.__bundle:
+            for pkg, item in self.__bundle.data['packages'].items():
+                # Most recent first, as in the history
+                sources = [digest for digest in item.get('history', []) if digest in item.get('deltas', {})]
+                if sources:
+                    deltas[pkg] = {'sha256': item['object'], 'from': sources}
+            return deltas
+        for pkg in PackageHistory().get_packages(self.arch):
+            package = self.get_package(pkg)
+            if not package:
                 continue
-        return None
+            sources = [source for source in PackageHistory().get(self.arch, pkg, package.etag)
+                       if DeltaCache().get(source, package, serve=False)]
+            if sources:
+                deltas[pkg] = {'sha256': package.etag, 'from': [etag for etag, _ in sources]}
+        return deltas
@@ -24,13 +24,15 @@ import os
 from pathlib import Path
 
 import arrow
-from flask import Blueprint, request, abort, send_file
+from flask import Blueprint, request, abort, send_file, jsonify
 from flask import Response
+from flask import current_app
 
 from epmanage import settings
 from epmanage.data.data_controller import DataController
 from epmanage.lib.auth import auth_required, current_identity
 from epmanage.lib.client import Client
+from epmanage.lib.package import Package, send_package
 
 data_component = Blueprint('data_component', __name__)
 
@@ -64,13 +66,23 @@ def data_do(blobid):
 @data_component.route('/report', methods=['POST'])
 @auth_required('urn:data')
 def data_report():
-    """Report entry point"""
+    """Report entry point, answers 207 with the lines which were not indexed
+
+    A report which is not a list of lines is rejected with 400, and 503 is answered when
+    Elasticsearch cannot be reached.
+    """
     agent = current_identity
     data_controller = DataController()
-    if data_controller.store_elk(agent, request.json):
-        return Response(status=201)
-    else:
+    errors = data_controller.store_elk(agent, request.json)
+    if errors is None:
         abort(400)
+    elif errors:
+        # Only these lines have to be sent again
+        resp = jsonify(errors=[dict(line=lineno, status=status, error=error) for lineno, status, error in errors])
+        resp.status_code = 207
+        return resp
+    else:
+        return Response(status=201)
 
 
 @data_component.route('/device-state', methods=['POST'])
@@ -129,8 +141,10 @@ def data_assets(token):
         path = pkg_path / name
         try:
             path.relative_to(pkg_path)
-        except ValueError:
+            size = path.stat().st_size
+        except (ValueError, OSError):
             abort(404)
 
-        rsp = send_file(str(path.absolute()))
-        return rsp
+        # Installers are named after their sha256, which is also their ETag
+        package = Package(str(path.absolute()), size, name)
+        return send_package(package, 'application/octet-stream', current_app.get_send_file_max_age(name))
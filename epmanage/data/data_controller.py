@@ -22,21 +22,31 @@ import logging
 from pathlib import Path
 
 from elasticsearch import Elasticsearch, ElasticsearchException
+from elasticsearch.helpers import streaming_bulk
 from elasticsearch_dsl import Search
 from eve.utils import config
 from flask import safe_join
+from werkzeug.exceptions import ServiceUnavailable
 
 from epmanage.lib.auth import current_identity
 from epmanage.utils import Singleton
 
 
+# Agent fields added to each report line
+REPORT_AGENT_FIELDS = ['hostname', 'uuid', 'os', 'osversion', 'arch', 'ostype', 'tags']
+
+
+class ReportStoreUnavailable(ServiceUnavailable):
+    """Raised (HTTP 503) when the report lines cannot reach Elasticsearch"""
+    description = "Reports cannot be stored now, please retry later"
+
+
 class DataController(metaclass=Singleton):
     """Data logic"""
 
     def __init__(self):
         self.es = Elasticsearch(hosts=config.ELASTIC_HOSTS)
-
-        pass
+        self.__indices = set()  # Report indices known to exist
 
     def store_blob(self, agent, blobid, data):
         """Store a blob"""
@@ -57,24 +67,69 @@ class DataController(metaclass=Singleton):
         except FileNotFoundError:
             return None
 
+    def __ensure_index(self, index):
+        if index not in self.__indices:
+            self.es.indices.create(index=index, ignore=400)
+            self.__indices.add(index)
+
     def store_elk(self, agent, data):
+        """Index the report lines with the bulk API
+
+        Returns the lines which could not be indexed as (line number, status, error),
+        None if the report is not valid. Raises ReportStoreUnavailable when Elasticsearch
+        cannot be reached for any line.
+        """
+        if not isinstance(data, list):
+            return None
         index = "report-{}".format(agent.get_client().token).lower()
         agent_data = dict()
-        for item in ['hostname', 'uuid', 'os', 'osversion', 'arch', 'ostype', 'tags']:
+        for item in REPORT_AGENT_FIELDS:
             agent_data['agent_{}'.format(item)] = agent[item]
 
+        errors = []
+        lines = []
+        for lineno, line in enumerate(data):
+            if isinstance(line, dict):
+                lines.append(lineno)
+            else:
+                errors.append((lineno, 400, "Report line is not an object"))
+
+        def actions():
+            for lineno in lines:
+                source = dict(data[lineno], **agent_data)
+                yield {
+                    '_index': index,
+                    '_type': source.pop('_key', 'unknown'),
+                    '_source': source
+                }
+
+        unreachable = 0
         try:
-            self.es.indices.create(index=index, ignore=400)
-            for line in data:
-                line.update(agent_data)
-                self.es.index(
-                    index=index,
-                    doc_type=line.pop('_key', 'unknown'),
-                    body=line)
-            return True
+            self.__ensure_index(index)
+            results = streaming_bulk(self.es, actions(),
+                                     chunk_size=config.ELASTIC_BULK_SIZE,
+                                     max_chunk_bytes=config.ELASTIC_BULK_MAX_BYTES,
+                                     raise_on_error=False,
+                                     raise_on_exception=False)
+            for lineno, (ok, result) in zip(lines, results):
+                if not ok:
+                    result = result.get('index', result)
+                    status = result.get('status')
+                    if 'exception' in result or not isinstance(status, int):
+                        # The chunk of this line did not reach Elasticsearch
+                        unreachable += 1
+                        status = 503
+                    errors.append((lineno, status, str(result.get('error'))))
         except ElasticsearchException:
             logging.exception("Elasticsearch exception")
-            return False
+            raise ReportStoreUnavailable()
+
+        if lines and unreachable == len(lines):
+            logging.error("Elasticsearch cannot be reached for the report lines of %s", index)
+            raise ReportStoreUnavailable()
+        if errors:
+            logging.warning("%d of %d report lines not indexed in %s", len(errors), len(data), index)
+        return sorted(errors)
 
     def store_state(self, agent, data):
         agent = agent.get_agent()
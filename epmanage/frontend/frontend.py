@@ -28,6 +28,8 @@ from epmanage import settings
 from epmanage.data.data_controller import DataController
 from epmanage.frontend.frontend_controller import FrontendController
 from epmanage.lib.auth import AuthController, auth_required, current_identity, AuthException
+from epmanage.lib.filter import FilterError
+from epmanage.lib.membership import FilterMembership
 from epmanage.lib.user import User
 from epmanage.utils import cors
 
@@ -256,3 +258,44 @@ def app_data(app_name, data_type):
         return jsonify(data=data)
     else:
         abort(406, "No such data")
+
+
+@frontend_component.route('/filter-preview', methods=['POST', 'OPTIONS'])
+@auth_required('urn:cmi_ro')
+@cors()
+def filter_preview():
+    """Count and sample the agents targeted by a filter before saving it"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+    try:
+        sample = int(request.args.get('sample', 10))
+    except ValueError:
+        abort(400)
+    if not 0 < sample <= 100:
+        abort(400)
+    try:
+        preview = FrontendController().preview_filter(current_identity, data, sample)
+    except FilterError as exc:
+        abort(422, str(exc))
+    if preview is None:
+        abort(404)
+    return jsonify(data=preview)
+
+
+@frontend_component.route('/filter-members/<name>', methods=['GET', 'OPTIONS'])
+@auth_required('urn:cmi_ro')
+@cors()
+def filter_members(name):
+    """Get the agents targeted by a filter"""
+    try:
+        skip = int(request.args.get('skip', 0))
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        abort(400)
+    if skip < 0 or not 0 < limit <= 1000:
+        abort(400)
+    client = current_identity.get_client()
+    return jsonify(data=dict(
+        count=FilterMembership.count(client, name),
+        agents=FilterMembership.get_agents(client, name, skip, limit)))
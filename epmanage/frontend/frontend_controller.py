@@ -30,7 +30,8 @@ from flask import url_for
 
 from epmanage import settings
 from epmanage.lib.agent import Agent
-from epmanage.lib.user import User
+from epmanage.lib.filter import compile_query
+from epmanage.lib.seats import SeatCounter
 from epmanage.utils import Singleton
 
 
@@ -44,6 +45,30 @@ class FrontendController(metaclass=Singleton):
     def load_pkg_data(self):
         self.__pkg_data = json.load(open(os.path.join(settings.config.PKG_PATH, 'pkg.json')))
 
+    @staticmethod
+    def preview_filter(identity, data: dict, sample: int = 10):
+        """Count and sample the agents matched by a filter, saved or not"""
+        if not identity:
+            return None
+        client = identity.get_client()
+        if not client or not client.db():
+            return None
+
+        filterdb = client.db()['filter']
+        if 'filters' not in data:
+            data = filterdb.find_one({'name': data.get('name')})
+            if not data:
+                return None
+        query = compile_query(data, lambda name: filterdb.find_one({'name': name}))
+
+        agentdb = Agent.ensure_indexes(client.db()['agent'])
+        agents = agentdb.find(query, {'_id': False, 'uuid': True, 'hostname': True, 'os': True,
+                                      'osversion': True}).limit(sample)
+        return dict(
+            count=agentdb.count(query),
+            agents=list(agents),
+        )
+
     def get_stats(self, identity):
         if not identity:
             return None
@@ -51,28 +76,29 @@ class FrontendController(metaclass=Singleton):
         if not client or not client.db():
             return None
 
+        seats = SeatCounter.get(client)
         data = dict(
             stats=[
                 dict(
                     key='lic_endpoints',
                     title='Licensed Endpoints',
                     category='device-management',
-                    count=Agent.get_active_agents(),
+                    count=seats.get('agents', 0),
                     max=client.max_agents
                 ),
                 dict(
                     key='lic_users',
                     title='Licensed Users',
                     category='user-management',
-                    count=User.get_active_users(),
+                    count=seats.get('users', 0),
                     max=client.max_users
                 ),
                 dict(
                     key='Endpoints',
                     title='Active Endpoints (weekly)',
                     category='device-management',
-                    count=Agent.get_weekly_active_agents(),
-                    max=Agent.get_active_agents()
+                    count=Agent.get_weekly_active_agents(client),
+                    max=seats.get('agents', 0)
                 )
             ],
             status={'level': 'warning', 'message': 'This is a beta, don\'t expect too much :p '},
@@ -18,6 +18,7 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
+import copy
 import logging
 import uuid
 from datetime import timedelta
@@ -27,10 +28,16 @@ from flask import current_app as app
 
 import epmanage.lib.auth
 from epmanage.lib.client import Client
+from epmanage.lib.lastseen import LastSeenBuffer
 from epmanage.lib.modelbase import Model
+from epmanage.lib.seats import SeatCounter, is_active_agent
+from epmanage.lib.tokencache import TokenCache, IssuedTokens
 
 logger = logging.getLogger(__name__)
 
+# Fields used to target agents (filter membership and filter queries)
+AGENT_INDEXES = ['_filters', 'hostname', 'os', 'ostype', 'osversion', 'tags.name']
+
 
 class Agent(Model):
     """Agent object (Endpoint)"""
@@ -93,10 +100,33 @@ class Agent(Model):
             is_new = True
 
         super(Agent, self).__init__(data, is_new)
+        # Issued tokens used to be stored in clear, they are removed on next save
+        if data.pop('_auth_token', None):
+            self._set_modified(True)
+        super(Agent, self).__setattr__('_snapshot', self.get_snapshot())
+        super(Agent, self).__setattr__('_was_active', not is_new and is_active_agent(data))
 
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+    @property
+    def client(self):
+        """Token of the client owning the agent"""
+        return self._token
+
+    def save(self):
+        super(Agent, self).save()
+        active = self.is_active()
+        if active != self._was_active:
+            SeatCounter.inc(self._token, agents=1 if active else -1)
+            super(Agent, self).__setattr__('_was_active', active)
+
+        # Cached tokens hold a snapshot of the agent, drop them if it has changed
+        snapshot = self.get_snapshot()
+        if snapshot != self._snapshot:
+            TokenCache().evict_agent(self._snapshot.get('uuid') or snapshot.get('uuid'))
+            super(Agent, self).__setattr__('_snapshot', snapshot)
+
     def prepare_data(self):
         if self.is_new():
             self.add_tag('new', 'system')
@@ -105,15 +135,27 @@ class Agent(Model):
         if not self._data.get('hostname'):
             self._data['hostname'] = 'unk_{}'.format(self._data['uuid'])
 
-        # Enforce active agents
+        # Enforce active agents when the agent takes a seat
         client = self.get_client()
-        if client:
-            active = Agent.get_active_agents(client)
+        if client and self.is_active() and not self._was_active:
             max_agents = client.max_agents
-            if max_agents and active >= max_agents:
-                logger.info("Agent cap exceded: forcing disabled tag for (%s)", self.email)
+            if max_agents and SeatCounter.get_agents(client) >= max_agents:
+                logger.info("Agent cap exceded: forcing disabled tag for (%s)", self.hostname)
                 self.add_tag('disabled', 'system')
 
+        # Materialized filter membership, when a field read by the filters or the filters have changed
+        if client:
+            from epmanage.lib.membership import FilterMembership  # Imports the task catalog
+            if self.get_snapshot() != self._snapshot or FilterMembership.is_stale(client, self._data):
+                fields = FilterMembership.compute(client, self._data)
+                if any(self._data.get(key) != value for key, value in fields.items()):
+                    self._data.update(fields)
+                    self._set_modified(True)
+
+    def is_active(self):
+        """Check if the agent uses a licensed seat"""
+        return is_active_agent(self._data)
+
     def add_tag(self, tagname, tagtype=None):
         """Add a tag to an agent"""
         tags = self._data.setdefault('tags', [])
@@ -133,9 +175,9 @@ class Agent(Model):
         tags = self._data.get('tags')
         if not tags:
             return False
-        for tag in tags.items():
+        for tag in tags:
             if tag.get('name') == tagname:
-                tags.pop(tag)
+                tags.remove(tag)
                 self._set_modified(True)
                 return True
         return False
@@ -155,11 +197,16 @@ class Agent(Model):
             duration = timedelta(hours=12)
         if any(tag['name'] == 'disabled' for tag in self._data.get('tags', [])):
             return None, 'The agent is disabled'
+        token = epmanage.lib.auth.AuthController.reuse_token(IssuedTokens().get(self.uuid), duration)
+        if token:
+            logger.debug("Reused token for {%s} (%s)", self.uuid, self.hostname)
+            return token, None
         token = epmanage.lib.auth.AuthController.generate_token(
             self.uuid,
             ['agent', 'urn:router', 'urn:code', 'urn:task', 'urn:data'],
             duration,
             extras=dict(aid=self._token))
+        IssuedTokens().set(self.uuid, token, duration.total_seconds())
         logger.info("Issued token for {%s} (%s)", self.uuid, self.hostname)
         return token, None
 
@@ -170,13 +217,26 @@ class Agent(Model):
             return None
         return client
 
+    def get_snapshot(self) -> dict:
+        """Get the agent fields kept with cached tokens"""
+        return {key: copy.deepcopy(self._data.get(key)) for key in AgentSnapshot.FIELDS}
+
     @staticmethod
-    def get_active_agents(client: Client = None):
-        if not client:
-            identity = epmanage.lib.auth.current_identity
-            client = identity.get_client()
-        agentdb = client.db()['agent']
-        return agentdb.count({'tags.name': {'$nin': ['disabled']}})
+    def eve_hook_evict_agent(item, original=None):
+        data = original if original else item
+        if data.get('uuid'):
+            TokenCache().evict_agent(data['uuid'])
+
+    __indexed = set()  # Agent databases where the indexes were created
+
+    @staticmethod
+    def ensure_indexes(agentdb):
+        """Create the targeting indexes of an agent collection, once per process"""
+        if agentdb.database.name not in Agent.__indexed:
+            for field in AGENT_INDEXES:
+                agentdb.create_index(field)
+            Agent.__indexed.add(agentdb.database.name)
+        return agentdb
 
     @staticmethod
     def get_weekly_active_agents(client: Client = None):
@@ -184,7 +244,42 @@ class Agent(Model):
             identity = epmanage.lib.auth.current_identity
             client = identity.get_client()
         agentdb = client.db()['agent']
+        # Write the buffered heartbeats of this client first
+        LastSeenBuffer().flush(agentdb.database.name)
         now = arrow.utcnow()
         return agentdb.count({'tags.name': {'$nin': ['disabled']},
                               'last_seen': {'$gte': now.replace(days=-7).datetime}
                               })
+
+
+class AgentSnapshot(object):
+    """Read-only view of an agent built from a cached token, the agent is loaded on demand"""
+    FIELDS = ['uuid', 'hostname', 'os', 'ostype', 'osversion', 'arch', 'version', 'tags', '_filters',
+              '_filters_version']
+
+    def __init__(self, client_token, data: dict):
+        self._token = client_token
+        self._data = data
+        self._agent = None
+
+    def __getattr__(self, item):
+        if item in AgentSnapshot.FIELDS:
+            return self._data.get(item)
+        if item == 'client':
+            return self._token
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return getattr(self.get_agent(), item)
+
+    def get_agent(self) -> Agent:
+        """Load the full agent object"""
+        if not self._agent:
+            self._agent = Agent(self._token, uuid=self._data.get('uuid'))
+        return self._agent
+
+    def get_client(self):
+        """Get the client object"""
+        client = Client(token=self._token)
+        if client.token != self._token:
+            return None
+        return client
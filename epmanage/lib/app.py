@@ -18,17 +18,24 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
+import copy
 import hashlib
 import json
+import logging
 from io import BufferedReader
 from typing import Optional
 
-from flask import current_app as app
+from flask import abort, current_app as app
 from gridfs import GridFS
 
 from epmanage.lib.auth import current_identity
 from epmanage.lib.modelbase import Model
 
+logger = logging.getLogger(__name__)
+
+# Increase when parse_config output changes
+PARSED_CONFIG_VERSION = 1
+
 
 class App(Model):
     """App object"""
@@ -50,6 +57,14 @@ class App(Model):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+    @classmethod
+    def from_data(cls, data: dict):
+        """Build an app from an already loaded document"""
+        obj = cls()
+        super(App, obj).__setattr__('_data', data)
+        obj._set_new(False)
+        return obj
+
     def prepare_data(self):
         if isinstance(self.logo, BufferedReader):
             grid = GridFS(self._modeldb.database)
@@ -63,7 +78,8 @@ class App(Model):
                 oid = grid.put(data)
             self.logo = oid
 
-    def parse_config(self, data: dict) -> dict:
+    def parse_config(self, data: dict, strict=False) -> dict:
+        """Convert the config variables to their type, invalid values raise ValueError if strict"""
         if not data:
             return {}
 
@@ -74,25 +90,40 @@ class App(Model):
                 val = configdict.get(variable['name'])  # type: str
                 if not val:
                     val = variable.get('default', '')
-                if variable['type'] == 'bool':
-                    config[variable['name']] = val.lower() == 'true'
-                elif variable['type'] == 'integer':
-                    # config[variable['name']] = human2bytes(val)
-                    if val:
-                        config[variable['name']] = int(val)
-                elif variable['type'] == 'string':
-                    config[variable['name']] = val
-                elif variable['type'] == 'list_of_strings':
-                    config[variable['name']] = []
-                    try:
-                        tmp = json.loads(val)
-                        if isinstance(tmp, list):
-                            for item in tmp:
-                                config[variable['name']] += item.split('|')
-                    except json.decoder.JSONDecodeError:
-                        pass
+                try:
+                    self.__parse_variable(config, variable, val, strict)
+                except (ValueError, TypeError, AttributeError) as exc:
+                    if not strict:
+                        raise
+                    raise ValueError("Invalid value for {}: {}".format(variable['name'], exc))
         return config
 
+    @staticmethod
+    def __parse_variable(config: dict, variable: dict, val, strict: bool):
+        if variable['type'] == 'bool':
+            config[variable['name']] = val.lower() == 'true'
+        elif variable['type'] == 'integer':
+            # config[variable['name']] = human2bytes(val)
+            if val:
+                config[variable['name']] = int(val)
+        elif variable['type'] == 'string':
+            config[variable['name']] = val
+        elif variable['type'] == 'list_of_strings':
+            config[variable['name']] = []
+            try:
+                tmp = json.loads(val)
+                if isinstance(tmp, list):
+                    for item in tmp:
+                        config[variable['name']] += item.split('|')
+            except json.decoder.JSONDecodeError:
+                if strict:
+                    raise
+
+    def get_parsed_version(self) -> str:
+        """Version of the parsed configs, changes with the configuration schema of the app"""
+        schema = json.dumps(self._data.get('configuration'), sort_keys=True, default=str).encode()
+        return '{}:{}'.format(PARSED_CONFIG_VERSION, hashlib.sha256(schema).hexdigest()[:16])
+
     def get_config(self, config_name: str) -> Optional[dict]:
         if not self._configdb:
             super(App, self).__setattr__('_configdb', current_identity.get_client().db()['config'])
@@ -100,8 +131,14 @@ class App(Model):
         if not config:
             return None
 
-        config = self.parse_config(config['configuration'])
         base_config = self._configdb.find_one({'name': '.global'})  # type: dict
+        return self.build_config(config, base_config)
+
+    def build_config(self, config: dict, base_config: Optional[dict]) -> dict:
+        """Parse a config document and merge it over the parsed .global config"""
+        if config.get('_parsed_version') == self.get_parsed_version():
+            return copy.deepcopy(config['_parsed'])
+        config = self.parse_config(config['configuration'])
         if base_config:
             base_config = self.parse_config(base_config['configuration'])
             for key, val in config.items():
@@ -110,3 +147,66 @@ class App(Model):
             return base_config
         else:
             return config
+
+    # EVE hooks, the parsed config is stored with the config documents
+    @staticmethod
+    def __prepare_config(item: dict, configdb):
+        """Parse a config document being written, raises ValueError if it is not valid"""
+        app_item = App(uappid=item.get('app_id'))
+        if app_item.is_new():
+            raise ValueError("Unknown app")
+        parsed = app_item.parse_config(item.get('configuration'), strict=True)
+        if item.get('name') != '.global':
+            base_config = configdb.find_one({'app_id': item['app_id'], 'name': '.global'})
+            if base_config:
+                merged = app_item.parse_config(base_config['configuration'])
+                merged.update({key: val for key, val in parsed.items() if val})
+                parsed = merged
+        item['_parsed'] = parsed
+        item['_parsed_version'] = app_item.get_parsed_version()
+
+    @staticmethod
+    def __prepare_or_abort(item: dict):
+        try:
+            App.__prepare_config(item, current_identity.get_client().db()['config'])
+        except ValueError as exc:
+            abort(422, str(exc))
+
+    @staticmethod
+    def eve_hook_insert_config(items):
+        for item in items:
+            App.__prepare_or_abort(item)
+
+    @staticmethod
+    def eve_hook_update_config(updates, original):
+        item = dict(original, **updates)
+        App.__prepare_or_abort(item)
+        updates['_parsed'] = item['_parsed']
+        updates['_parsed_version'] = item['_parsed_version']
+
+    @staticmethod
+    def eve_hook_replace_config(item, original):
+        App.__prepare_or_abort(item)
+
+    @staticmethod
+    def eve_hook_refresh_configs(*args):
+        """The configs of an app are merged over its .global config, parse them again when it changes"""
+        app_ids = set()
+        for arg in args:
+            for data in arg if isinstance(arg, list) else [arg]:
+                if isinstance(data, dict) and data.get('name') == '.global' and data.get('app_id'):
+                    app_ids.add(data['app_id'])
+        if not app_ids:
+            return
+        configdb = current_identity.get_client().db()['config']
+        for config in configdb.find({'app_id': {'$in': list(app_ids)}, 'name': {'$ne': '.global'}}):
+            try:
+                App.__prepare_config(config, configdb)
+            except ValueError as exc:
+                # Parsed again on use, as before
+                logger.error("Config %s of app %s is not valid: %s", config.get('name'), config['app_id'], exc)
+                configdb.update_one({'_id': config['_id']}, {'$unset': {'_parsed': True, '_parsed_version': True}})
+                continue
+            configdb.update_one({'_id': config['_id']}, {'$set': {
+                '_parsed': config['_parsed'],
+                '_parsed_version': config['_parsed_version']}})
@@ -30,13 +30,15 @@ import arrow
 import jwt
 from emails.template import JinjaTemplate as T
 from eve.auth import TokenAuth
-from flask import request, Response, abort, current_app as app
+from flask import request, Response, abort, g, current_app as app
 from flask.ext.emails import Message
 from werkzeug.local import LocalProxy
 
 import epmanage.lib.agent
 import epmanage.lib.client
 import epmanage.lib.user
+from epmanage.lib.tokencache import TokenCache
+from epmanage.utils import KeyRing
 
 current_identity = LocalProxy(lambda: AuthController.get_current_identity())  # type: Identity
 
@@ -54,6 +56,15 @@ class Identity(object):
 
     def __init__(self, token):
         self.__raw_token = token
+
+        # Agent tokens verified recently come with a snapshot of the agent
+        cached = TokenCache().get(token)
+        if cached:
+            self.__token, snapshot = cached
+            self.__object = epmanage.lib.agent.AgentSnapshot(self.__token['aid'], snapshot)
+            self.__internal_type = 'agent'
+            return
+
         self.__token = self.__check_token('', options=dict(verify_aud=False))
         if not self.__token:
             raise AuthException("Invalid token")
@@ -63,6 +74,8 @@ class Identity(object):
         elif 'agent' in self.__token['aud']:
             self.__object = epmanage.lib.agent.Agent.from_token(self.__token)
             self.__internal_type = 'agent'
+            if not self.__object.is_new():
+                TokenCache().set(token, self.__token, self.__object.get_snapshot())
         else:
             raise AuthException("Bad token")
 
@@ -70,7 +83,11 @@ class Identity(object):
         return self.__object if self.__internal_type == 'user' else None
 
     def get_agent(self):
-        return self.__object if self.__internal_type == 'agent' else None
+        if self.__internal_type != 'agent':
+            return None
+        if isinstance(self.__object, epmanage.lib.agent.AgentSnapshot):
+            self.__object = self.__object.get_agent()
+        return self.__object
 
     def get_client(self):
         return self.__object.get_client()
@@ -106,15 +123,25 @@ class Identity(object):
             require_iat=True,
             require_nbf=True)
         decode_options.update(options)
+        # Debug counter, one decode per request is expected
+        g.token_decodes = getattr(g, 'token_decodes', 0) + 1
         try:
+            header = jwt.get_unverified_header(self.__raw_token)
+            algorithm = header.get('alg')
+            if algorithm not in app.config.AUTH_ALGORITHMS:
+                return None
+            pubkey = KeyRing().get_verifying_key(header.get('kid'))
+            if not pubkey:
+                return None
             data = jwt.decode(self.__raw_token,
-                              open(app.config.AUTH_PUBKEY).read(),
-                              algorithm='RS512',
+                              pubkey,
+                              algorithms=[algorithm],
                               options=decode_options,
                               issuer='auth_module',
                               audience=audience)
             return data
-        except jwt.exceptions.InvalidTokenError:
+        except (jwt.exceptions.InvalidTokenError, jwt.exceptions.InvalidKeyError, TypeError):
+            # TypeError: the key type does not match the token algorithm
             return None
 
     def renew_token(self):
@@ -167,8 +194,7 @@ class AuthController(object):
         token, error = agent.get_token()
         if error:
             raise AuthException(error)
-        agent.last_seen = arrow.utcnow().datetime
-        agent.save()
+        agent.touch()
         return token
 
     @staticmethod
@@ -194,8 +220,7 @@ class AuthController(object):
             token, error = user.get_token()
             if error:
                 raise AuthException(error)
-            user.last_seen = arrow.utcnow().datetime
-            user.save()
+            user.touch()
             return token
         else:
             # Return restricted token
@@ -208,11 +233,28 @@ class AuthController(object):
     def renew_token():
         """Renew the token is present in headers"""
         if current_identity:
-            return current_identity.renew_token()
+            token = current_identity.renew_token()
+            if token:
+                AuthController.reset_current_identity()
+            return token
         return None
 
     @staticmethod
     def get_current_identity(force=False):
+        """Get the identity of the current request, resolved once per request"""
+        if not force and hasattr(g, 'identity'):
+            return g.identity
+        g.identity = AuthController.__get_identity()
+        return g.identity
+
+    @staticmethod
+    def reset_current_identity():
+        """Forget the identity of the current request, it will be resolved again on next access"""
+        if hasattr(g, 'identity'):
+            del g.identity
+
+    @staticmethod
+    def __get_identity():
         token = request.headers.get('Authorization')
         # Check if token is present in headers
         if token:
@@ -220,8 +262,7 @@ class AuthController(object):
             # Check token format
             if len(tmp) == 2 and tmp[0] == 'Bearer':
                 try:
-                    AuthController.__identity = Identity(tmp[1])
-                    return AuthController.__identity
+                    return Identity(tmp[1])
                 except AuthException:
                     return None
         return None
@@ -242,13 +283,41 @@ class AuthController(object):
         }
         if extras:
             tokendict.update(extras)
+        kid, privkey = KeyRing().get_signing_key()
+        if not privkey:
+            raise AuthException("No signing key available")
         token = jwt.encode(
             tokendict,
-            open(app.config.AUTH_PRIVKEY).read(),
-            algorithm='RS512'
+            privkey,
+            algorithm=app.config.AUTH_ALGORITHM,
+            headers=dict(kid=kid)
         )
         return token
 
+    @staticmethod
+    def reuse_token(token, duration: timedelta):
+        """
+        Check if a previously issued token can be handed out again
+        :param token: the token issued last time
+        :param duration: the lifetime of a new token
+        :return: the token if it is signed with the current key and has enough lifetime left, None otherwise
+        """
+        if not token or not app.config.AUTH_TOKEN_REUSE:
+            return None
+        try:
+            header = jwt.get_unverified_header(token)
+            # The token was issued by this process, only its lifetime matters here
+            claims = jwt.decode(token, options=dict(verify_signature=False, verify_aud=False))
+        except jwt.exceptions.InvalidTokenError:
+            return None
+        kid, _ = KeyRing().get_signing_key()
+        if header.get('alg') != app.config.AUTH_ALGORITHM or header.get('kid') != kid:
+            return None
+        remaining = claims.get('exp', 0) - arrow.utcnow().timestamp
+        if remaining < duration.total_seconds() * app.config.AUTH_TOKEN_REUSE:
+            return None
+        return token
+
     @staticmethod
     def invite(data: dict):
         """
@@ -0,0 +1,218 @@
+"""
+catalog.py : Per client snapshot of the task catalog
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+import json
+import logging
+import time
+from typing import List
+
+import arrow
+from flask import current_app as app
+
+import epmanage.settings as settings
+from epmanage.lib.app import App
+from epmanage.lib.auth import current_identity
+from epmanage.lib.filter import compile_filter, get_agent_value, FilterError
+from epmanage.utils import Singleton, LRUCache
+
+logger = logging.getLogger(__name__)
+
+APPS_KEY = '.apps'  # Version of the global app collection
+
+
+class CatalogSnapshot(object):
+    """Actions of a client with their compiled filter, app and parsed config
+
+    Built in bulk with one query per collection, the task resolution is then done in memory.
+    The snapshot is shared between requests and must not be modified.
+    """
+
+    def __init__(self, version: tuple, actions: List[dict], filters: List[dict], apps: List[dict],
+                 configs: List[dict], filters_version=0):
+        self.version = version
+        self.filters_version = filters_version  # Version of the materialized filter membership
+        self.checked = time.monotonic()
+        self.filters = {flt['name']: flt for flt in filters}
+        self.apps = {item['uappid']: App.from_data(item) for item in apps}
+        self.configs = {(config['app_id'], config['name']): config for config in configs}
+        self.compiled = dict()  # Filter name -> CompiledFilter, None if invalid
+        self.payloads = dict()  # Config hash -> serialized parsed config
+        self.tasks = []  # (action, predicate, app name, config, config reference)
+
+        for name, flt in self.filters.items():
+            try:
+                self.compiled[name] = compile_filter(flt, self.filters.get)
+            except FilterError as exc:
+                logger.error("Filter list not valid: %s", exc)
+                self.compiled[name] = None
+
+        for action in actions:
+            predicate = self.compiled.get(action.get('filter'))
+            app_item = self.apps.get(action.get('app_id'))
+            if predicate and app_item:
+                self.tasks.append((action, predicate, app_item.name) + self.__get_config(app_item, action))
+
+    def __get_config(self, app_item: App, action: dict) -> tuple:
+        """Get the (config, config reference) of an action"""
+        config = self.configs.get((app_item.uappid, action.get('config')))
+        if not config:
+            return None, None
+        config = app_item.build_config(config, self.configs.get((app_item.uappid, '.global')))
+
+        schedule = config.pop('schedule', None)
+        if schedule and schedule in ['daily', 'weekly', 'monthly']:
+            schedule = dict(
+                type='period',
+                value1=schedule
+            )
+        if action.get('schedule'):
+            schedule = action.get('schedule')
+
+        # Configs are shared by many actions and agents, they are stored once by content hash
+        payload = json.dumps(config, sort_keys=True, separators=(',', ':')).encode()
+        config_hash = hashlib.sha256(payload).hexdigest()
+        self.payloads[config_hash] = payload
+        reference = dict(config_hash=config_hash, _schedule=schedule, task_id=str(action['_id']))
+
+        config['_schedule'] = schedule
+        config['task_id'] = str(action['_id'])
+        return config, reference
+
+    def get_filters(self, agent) -> List[str]:
+        """Evaluate every filter for an agent, returns the names of those matching"""
+        return sorted(name for name, predicate in self.compiled.items() if predicate and predicate(agent))
+
+    def get_tasks(self, agent, references=False) -> dict:
+        """Get the active tasks of an agent, with config references to the payloads if requested"""
+        # Use the materialized filter membership when it is up to date, evaluate the filters otherwise
+        members = get_agent_value(agent, '_filters')
+        if get_agent_value(agent, '_filters_version') != self.filters_version:
+            members = None
+        tasks = dict()
+        for action, predicate, app_name, config, reference in self.tasks:
+            if references:
+                config = reference
+            if not (predicate.name in members if members is not None else predicate(agent)):
+                continue
+            if app_name not in tasks:
+                tasks[app_name] = dict(
+                    app=app_name,
+                    module='{module}.{module}'.format(module=app_name),
+                    configs=[]
+                )
+            if config is not None:
+                tasks[app_name]['configs'].append(config)
+        return tasks
+
+
+class TaskCatalog(metaclass=Singleton):
+    """Catalog snapshots per client
+
+    The catalog version of each client is a counter in the global catalog collection,
+    increased by the Eve hooks when an action, a filter or a config is written. Apps share
+    a global counter. Snapshots are rebuilt when the version changes, which is checked at
+    most every CATALOG_CHECK_INTERVAL seconds. Filter writes also increase the filters
+    counter and mark the filter membership of the client for refresh.
+    """
+
+    def __init__(self):
+        self.__cache = LRUCache(settings.config.CATALOG_CACHE_SIZE)
+
+    @staticmethod
+    def __db():
+        return app.data.pymongo('client').db['catalog']
+
+    @staticmethod
+    def __get_versions(token: str) -> tuple:
+        """Get the (client, apps) catalog version and the filters version"""
+        versions = {item['_id']: item for item in TaskCatalog.__db().find({'_id': {'$in': [token, APPS_KEY]}})}
+        client, apps = versions.get(token, {}), versions.get(APPS_KEY, {})
+        return (client.get('version', 0), apps.get('version', 0)), client.get('filters', 0)
+
+    @staticmethod
+    def get_version(token: str) -> tuple:
+        """Get the (client, apps) catalog version"""
+        return TaskCatalog.__get_versions(token)[0]
+
+    @staticmethod
+    def build(client, version: tuple, filters_version=0) -> CatalogSnapshot:
+        """Load the catalog of a client"""
+        db = client.db()
+        actions = list(db['action'].find())
+        app_ids = list({action.get('app_id') for action in actions})
+        return CatalogSnapshot(
+            version,
+            actions,
+            list(db['filter'].find()),
+            list(app.data.pymongo('app').db['app'].find({'uappid': {'$in': app_ids}})),
+            list(db['config'].find({'app_id': {'$in': app_ids}})),
+            filters_version)
+
+    def get(self, client) -> CatalogSnapshot:
+        """Get the current catalog snapshot of a client"""
+        snapshot = self.__cache.get(client.token)
+        if snapshot and time.monotonic() - snapshot.checked < settings.config.CATALOG_CHECK_INTERVAL:
+            return snapshot
+
+        # Filter writes increase both counters, the client version is enough to compare
+        version, filters_version = self.__get_versions(client.token)
+        if snapshot and snapshot.version == version:
+            snapshot.checked = time.monotonic()
+            return snapshot
+
+        snapshot = self.build(client, version, filters_version)
+        self.__cache.set(client.token, snapshot)
+        return snapshot
+
+    def peek(self, token: str):
+        """Get the cached snapshot of a client, None if not loaded"""
+        return self.__cache.get(token)
+
+    def invalidate(self, token: str):
+        """Forget the snapshot of a client, it will be loaded again on next use"""
+        self.__cache.pop(token)
+
+    def bump(self, token: str, filters=False):
+        """Increase the catalog version, for a client token or APPS_KEY"""
+        update = {'$inc': {'version': 1}}
+        if filters:
+            update = {'$inc': {'version': 1, 'filters': 1},
+                      '$set': {'members_pending': True, 'filters_updated': arrow.utcnow().datetime}}
+        self.__db().update_one({'_id': token}, update, upsert=True)
+        from epmanage.lib.notifier import CatalogNotifier  # Imports the task catalog
+        if token == APPS_KEY:
+            self.__cache.clear()
+            CatalogNotifier().notify_all()
+        else:
+            self.__cache.pop(token)
+            CatalogNotifier().notify(token)
+
+    @staticmethod
+    def eve_hook_bump(*args):
+        client = current_identity.get_client()
+        if client:
+            TaskCatalog().bump(client.token)
+
+    @staticmethod
+    def eve_hook_bump_filters(*args):
+        client = current_identity.get_client()
+        if client:
+            TaskCatalog().bump(client.token, filters=True)
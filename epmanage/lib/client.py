@@ -18,10 +18,28 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
+import copy
+
 from flask import current_app as app
 
+import epmanage.settings as settings
 from epmanage.default_data import database_template
 from epmanage.lib.modelbase import Model
+from epmanage.utils import Singleton, LRUCache
+
+
+class ClientCache(LRUCache, metaclass=Singleton):
+    """Client documents by token, shared by the process"""
+
+    def __init__(self):
+        super(ClientCache, self).__init__(settings.config.CLIENT_CACHE_SIZE, settings.config.CLIENT_CACHE_TTL)
+
+    def get(self, key, default=None):
+        value = super(ClientCache, self).get(key)
+        return copy.deepcopy(value) if value is not None else default
+
+    def set(self, key, value, expire=None):
+        super(ClientCache, self).set(key, copy.deepcopy(value), expire)
 
 
 class Client(Model):
@@ -33,7 +51,11 @@ class Client(Model):
         data = None
         is_new = False
         if 'token' in kwargs:
-            data = self._modeldb.find_one({'token': kwargs.get('token')})
+            data = ClientCache().get(kwargs.get('token'))
+            if data is None:
+                data = self._modeldb.find_one({'token': kwargs.get('token')})
+                if data:
+                    ClientCache().set(data['token'], data)
         if 'name' in kwargs:
             data = self._modeldb.find_one({'name': kwargs.get('name')})
         if 'registration_token' in kwargs:
@@ -55,6 +77,13 @@ class Client(Model):
     def db(self):
         return self._db
 
+    def save(self):
+        super(Client, self).save()
+        if self.token:
+            ClientCache().pop(self.token)
+            settings.config.invalidate_database_settings(self.token)
+            app.data.invalidate_prefix('MONGOCLIENT_{}'.format(self.token))
+
     def insert_default_data(self):
         prefix = 'MONGOCLIENT_{}'.format(self.token)
         for collection, data in database_template.items():
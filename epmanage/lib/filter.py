@@ -21,13 +21,16 @@ along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 import enum
 import fnmatch
 import logging
-from typing import List
+import re
+from typing import Callable, List
 
 from flask import abort
 
 from epmanage.lib.auth import current_identity
 from epmanage.lib.modelbase import Model
 
+logger = logging.getLogger(__name__)
+
 
 class VarFilter(enum.Enum):
     """Filteritem variable"""
@@ -51,6 +54,217 @@ class OperatorFilter(enum.Enum):
         return (self == OperatorFilter.OR) or (self == OperatorFilter.AND)
 
 
+class FilterError(ValueError):
+    """Raised when a filter cannot be compiled"""
+    pass
+
+
+class CompiledFilter(object):
+    """Predicate compiled from a filter definition, call it with an agent to evaluate it
+
+    The filter items are an infix expression where AND binds tighter than OR. It is
+    compiled to a list of AND groups, evaluated with short-circuit.
+    """
+
+    def __init__(self, name: str, groups: List[List[Callable]], variables: set, dependencies: set):
+        self.name = name
+        self.groups = groups
+        self.variables = variables  # Agent fields read by the filter
+        self.dependencies = dependencies  # Names of the filters referenced by filtername items
+
+    def __call__(self, agent) -> bool:
+        return any(all(term(agent) for term in group) for group in self.groups)
+
+
+def never(agent) -> bool:
+    return False
+
+
+def get_agent_value(agent, name: str):
+    """Read an agent field from an Identity, an Agent or a dict"""
+    try:
+        return agent[name]
+    except (KeyError, TypeError):
+        return getattr(agent, name, None)
+
+
+def compile_matcher(pattern: str, operator: OperatorFilter) -> Callable:
+    """Compile a value matcher, like patterns are translated to a regex only once"""
+    if operator == OperatorFilter.equal:
+        if pattern == '<any>':
+            return lambda value: True
+        return lambda value: value == pattern
+    regex = re.compile(fnmatch.translate(pattern))
+    return lambda value: isinstance(value, str) and regex.match(value) is not None
+
+
+def compile_filteritem(filteritem: dict, resolver, stack: tuple) -> (Callable, set, set):
+    """Compile a single filter item, returns (predicate, variables, dependencies)"""
+    try:
+        var = VarFilter(filteritem.get('variable'))
+        operator = OperatorFilter(filteritem['operator'])
+    except (KeyError, ValueError):
+        raise FilterError("Invalid filter item {}".format(filteritem))
+
+    if var == VarFilter.filtername:
+        name = filteritem.get('value')
+        if name in stack:
+            raise FilterError("Filter cycle: {}".format(' > '.join(stack + (name,))))
+        subfilter = resolver(name)
+        if not subfilter:
+            logger.warning("Filter %s references unknown filter %s", stack[-1], name)
+            return never, set(), {name}
+        compiled = compile_filter(subfilter, resolver, stack)
+        return compiled, compiled.variables, compiled.dependencies | {name}
+
+    match = compile_matcher(filteritem.get('value'), operator)
+    if var == VarFilter.tag:
+        def predicate(agent):
+            return any(match(tag.get('name')) for tag in get_agent_value(agent, 'tags') or [])
+        return predicate, {'tags'}, set()
+
+    def predicate(agent):
+        return match(get_agent_value(agent, var.name))
+    return predicate, {var.name}, set()
+
+
+def compile_filter(data: dict, resolver, stack: tuple = ()) -> CompiledFilter:
+    """Compile a filter document
+
+    :param data: the filter document
+    :param resolver: function returning the filter document for a name, None if unknown
+    :param stack: names of the filters being compiled, to detect cycles
+    """
+    name = data.get('name')
+    stack += (name,)
+    groups = [[]]
+    variables = set()
+    dependencies = set()
+    expect_term = True
+    for filteritem in data.get('filters') or []:
+        try:
+            operator = OperatorFilter(filteritem.get('operator'))
+        except ValueError:
+            raise FilterError("Invalid operator in filter {}".format(name))
+        if operator.is_binop():
+            if expect_term:
+                raise FilterError("Misplaced {} in filter {}".format(operator.name, name))
+            if operator == OperatorFilter.OR:
+                groups.append([])
+        else:
+            if not expect_term:
+                raise FilterError("Missing operator in filter {}".format(name))
+            predicate, item_variables, item_dependencies = compile_filteritem(filteritem, resolver, stack)
+            groups[-1].append(predicate)
+            variables |= item_variables
+            dependencies |= item_dependencies
+        expect_term = operator.is_binop()
+    if expect_term:
+        raise FilterError("Incomplete filter {}".format(name))
+    return CompiledFilter(name, groups, variables, dependencies)
+
+
+def glob_to_regex(pattern: str) -> str:
+    """Translate a like pattern to an anchored regex, with the fnmatch syntax"""
+    index, length = 0, len(pattern)
+    regex = ''
+    while index < length:
+        char = pattern[index]
+        index += 1
+        if char == '*':
+            regex += '.*'
+        elif char == '?':
+            regex += '.'
+        elif char == '[':
+            end = index
+            if end < length and pattern[end] == '!':
+                end += 1
+            if end < length and pattern[end] == ']':
+                end += 1
+            while end < length and pattern[end] != ']':
+                end += 1
+            if end >= length:
+                regex += '\\['
+            else:
+                chars = pattern[index:end].replace('\\', '\\\\')
+                index = end + 1
+                if chars[0] == '!':
+                    chars = '^' + chars[1:]
+                elif chars[0] == '^':
+                    chars = '\\' + chars
+                regex += '[{}]'.format(chars)
+        else:
+            regex += re.escape(char)
+    return '^{}$'.format(regex)
+
+
+# Matches no document, for references to unknown filters
+QUERY_NEVER = {'_id': {'$exists': False}}
+
+
+def compile_query_item(filteritem: dict, resolver, stack: tuple) -> dict:
+    """Translate a single filter item to a MongoDB query on the agent collection"""
+    try:
+        var = VarFilter(filteritem.get('variable'))
+        operator = OperatorFilter(filteritem['operator'])
+    except (KeyError, ValueError):
+        raise FilterError("Invalid filter item {}".format(filteritem))
+
+    if var == VarFilter.filtername:
+        name = filteritem.get('value')
+        if name in stack:
+            raise FilterError("Filter cycle: {}".format(' > '.join(stack + (name,))))
+        subfilter = resolver(name)
+        if not subfilter:
+            return QUERY_NEVER
+        return compile_query(subfilter, resolver, stack)
+
+    field = 'tags.name' if var == VarFilter.tag else var.name
+    pattern = filteritem.get('value')
+    if operator == OperatorFilter.equal:
+        if pattern != '<any>':
+            return {field: pattern}
+        # Any tag matches, but the agent needs at least one
+        return {'tags.0': {'$exists': True}} if var == VarFilter.tag else {}
+    return {field: {'$regex': glob_to_regex(pattern)}}
+
+
+def compile_query(data: dict, resolver, stack: tuple = ()) -> dict:
+    """Translate a filter document to a MongoDB query on the agent collection
+
+    Matches the same agents as compile_filter, referenced filters are inlined.
+    """
+    name = data.get('name')
+    stack += (name,)
+    groups = [[]]
+    expect_term = True
+    for filteritem in data.get('filters') or []:
+        try:
+            operator = OperatorFilter(filteritem.get('operator'))
+        except ValueError:
+            raise FilterError("Invalid operator in filter {}".format(name))
+        if operator.is_binop():
+            if expect_term:
+                raise FilterError("Misplaced {} in filter {}".format(operator.name, name))
+            if operator == OperatorFilter.OR:
+                groups.append([])
+        else:
+            if not expect_term:
+                raise FilterError("Missing operator in filter {}".format(name))
+            groups[-1].append(compile_query_item(filteritem, resolver, stack))
+        expect_term = operator.is_binop()
+    if expect_term:
+        raise FilterError("Incomplete filter {}".format(name))
+
+    clauses = []
+    for group in groups:
+        group = [query for query in group if query]
+        if not group:
+            return {}  # One group matches every agent
+        clauses.append(group[0] if len(group) == 1 else {'$and': group})
+    return clauses[0] if len(clauses) == 1 else {'$or': clauses}
+
+
 class Filter(Model):
     """Filter object"""
 
@@ -76,91 +290,3 @@ class Filter(Model):
         for flt in data:
             if flt['owner'] == 'system':
                 abort(403, "Cannot delete system filters")
-
-    @staticmethod
-    def __match_value(value, pattern, operator):
-        if operator == OperatorFilter.equal:
-            return True if pattern == '<any>' else value == pattern
-        elif operator == OperatorFilter.like:
-            return fnmatch.fnmatch(value, pattern)
-
-    def __eval_filteritem(self, filteritem, agent):
-        var = VarFilter(filteritem['variable'])
-        operator = OperatorFilter(filteritem['operator'])
-
-        if var == VarFilter.tag:
-            try:
-                return any(
-                    t for t in agent['tags']
-                    if self.__match_value(t.get('name'), filteritem['value'], operator))
-            except KeyError:
-                return False
-        elif var == VarFilter.filtername:
-            return self.is_filter_applicable(filteritem['value'], agent)
-
-        return self.__match_value(agent[var.name], filteritem['value'], operator)
-
-    @staticmethod
-    def __eval_and(evaltab):
-        index = 0
-        while True:
-            if len(evaltab) < 3:
-                break
-            try:
-                lval, operator, rval = evaltab[index:index + 3]
-                if operator == OperatorFilter.AND:
-                    del evaltab[index:index + 3]
-                    evaltab.insert(index, lval & rval)
-                else:
-                    index += 2
-            except (ValueError, IndexError):
-                break
-        return evaltab
-
-    @staticmethod
-    def __eval_or(evaltab):
-        index = 0
-        while True:
-            if len(evaltab) < 3:
-                break
-            try:
-                lval, operator, rval = evaltab[index:index + 3]
-                if operator == OperatorFilter.OR:
-                    del evaltab[index:index + 3]
-                    evaltab.insert(index, lval | rval)
-                else:
-                    index += 2
-            except (ValueError, IndexError):
-                break
-        return evaltab
-
-    def is_applicable(self, agent):
-        """Check if a filter is applicable for an agent"""
-        evaltab = []
-        for filteritem in self.filters:
-            operator = OperatorFilter(filteritem['operator'])
-            if not operator.is_binop():
-                evaltab.append(self.__eval_filteritem(filteritem, agent))
-            else:
-                evaltab.append(operator)
-
-        # Single value tab
-        if len(evaltab) == 1:
-            return evaltab[0]
-
-        # Process AND
-        evaltab = self.__eval_and(evaltab)
-
-        # Single value tab
-        if len(evaltab) == 1:
-            return evaltab[0]
-
-        # Process OR
-        evaltab = self.__eval_or(evaltab)
-
-        # Single value tab
-        if len(evaltab) == 1:
-            return evaltab[0]
-
-        logging.error("Filter list not valid")
-        return False
@@ -0,0 +1,81 @@
+"""
+lastseen.py : Write-behind buffer for last_seen heartbeats
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import threading
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+import epmanage.settings as settings
+from epmanage.utils import Singleton, Periodic
+
+logger = logging.getLogger(__name__)
+
+
+class LastSeenBuffer(metaclass=Singleton):
+    """Coalesce last_seen updates in memory and write them with one bulk_write per collection
+
+    Updates use $max so that a late flush never moves last_seen backwards. Pending updates
+    are written every LAST_SEEN_FLUSH_INTERVAL seconds, when LAST_SEEN_MAX_PENDING is
+    reached and when the process exits.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__pending = dict()  # (database, collection) -> (collection, {_id: last_seen})
+        self.__count = 0
+        self.__flusher = Periodic(self.flush, settings.config.LAST_SEEN_FLUSH_INTERVAL, at_exit=True)
+
+    def __add(self, collection, items: dict):
+        key = (collection.database.name, collection.name)
+        with self.__lock:
+            _, pending = self.__pending.setdefault(key, (collection, dict()))
+            for oid, last_seen in items.items():
+                if oid not in pending:
+                    self.__count += 1
+                    pending[oid] = last_seen
+                elif pending[oid] < last_seen:
+                    pending[oid] = last_seen
+            return self.__count >= settings.config.LAST_SEEN_MAX_PENDING
+
+    def touch(self, collection, oid, last_seen):
+        """Record a heartbeat for the document oid of the collection"""
+        full = self.__add(collection, {oid: last_seen})
+        self.__flusher.start()
+        if full:
+            self.flush()
+
+    def flush(self, database: str = None):
+        """Write the pending updates, only those of a database if specified"""
+        with self.__lock:
+            keys = [key for key in self.__pending.keys() if database is None or key[0] == database]
+            batches = [self.__pending.pop(key) for key in keys]
+            self.__count -= sum(len(items) for _, items in batches)
+
+        for collection, items in batches:
+            requests = [UpdateOne({'_id': oid}, {'$max': {'last_seen': last_seen}})
+                        for oid, last_seen in items.items()]
+            try:
+                collection.bulk_write(requests, ordered=False)
+            except PyMongoError:
+                # Keep the updates for the next flush
+                logger.exception("Cannot flush last_seen for %s.%s", collection.database.name, collection.name)
+                self.__add(collection, items)
@@ -0,0 +1,175 @@
+"""
+membership.py : Materialized filter membership of the agents
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+from typing import List
+
+import arrow
+from flask import current_app as app
+from pymongo import UpdateOne, ReturnDocument
+
+import epmanage.settings as settings
+from epmanage.lib.agent import Agent
+from epmanage.lib.auth import current_identity
+from epmanage.lib.catalog import TaskCatalog
+from epmanage.lib.client import Client
+from epmanage.lib.tokencache import TokenCache
+from epmanage.utils import Periodic
+
+logger = logging.getLogger(__name__)
+
+# Agent fields read by the filters
+MEMBERSHIP_FIELDS = ['uuid', 'hostname', 'os', 'osversion', 'ostype', 'tags', '_filters', '_filters_version']
+BATCH_SIZE = 1000
+
+
+class FilterMembership(object):
+    """Names of the filters matching each agent, stored in the _filters field of the agent
+
+    _filters_version is the filters version of the catalog the membership was computed
+    with. The fields are computed when an agent is written. When a filter is written, a
+    background job recomputes them for the agents of the client, and the task dispatch
+    evaluates the filters of the agents whose membership is not up to date meanwhile.
+    """
+
+    @staticmethod
+    def compute(client, data: dict) -> dict:
+        """Get the membership fields of an agent document"""
+        snapshot = TaskCatalog().get(client)
+        return {'_filters': snapshot.get_filters(data), '_filters_version': snapshot.filters_version}
+
+    @staticmethod
+    def is_stale(client, data: dict) -> bool:
+        """Check if the membership of an agent document is not up to date"""
+        return data.get('_filters') is None or \
+            data.get('_filters_version') != TaskCatalog().get(client).filters_version
+
+    @staticmethod
+    def __agentdb(client):
+        return Agent.ensure_indexes(client.db()['agent'])
+
+    @staticmethod
+    def count(client, name: str) -> int:
+        """Count the agents matching a filter"""
+        return FilterMembership.__agentdb(client).count({'_filters': name})
+
+    @staticmethod
+    def get_agents(client, name: str, skip=0, limit=0) -> List[dict]:
+        """List the agents matching a filter"""
+        cursor = FilterMembership.__agentdb(client).find(
+            {'_filters': name}, {'_id': False, 'uuid': True, 'hostname': True}).sort('hostname')
+        return list(cursor.skip(skip).limit(limit))
+
+    @staticmethod
+    def refresh(client) -> int:
+        """Recompute the membership of the agents of a client which is not up to date
+
+        Returns the filters version the membership was computed with.
+        """
+        # Read the current version, not a snapshot cached before the filter change
+        TaskCatalog().invalidate(client.token)
+        snapshot = TaskCatalog().get(client)
+        version = snapshot.filters_version
+
+        agentdb = FilterMembership.__agentdb(client)
+        requests = []
+        uuids = set()
+        for data in agentdb.find({'_filters_version': {'$ne': version}}, MEMBERSHIP_FIELDS):
+            # Only the agents still on another version, a save may have refreshed one meanwhile
+            requests.append(UpdateOne(
+                {'_id': data['_id'], '_filters_version': data.get('_filters_version')},
+                {'$set': {'_filters': snapshot.get_filters(data), '_filters_version': version}}))
+            uuids.add(data.get('uuid'))
+            if len(requests) >= BATCH_SIZE:
+                agentdb.bulk_write(requests, ordered=False)
+                requests = []
+        if requests:
+            agentdb.bulk_write(requests, ordered=False)
+
+        # Cached tokens hold the previous membership
+        if uuids:
+            TokenCache().evict_agents(uuids)
+        logger.info("Filter membership of %s refreshed to version %s: %d agents", client.token, version, len(uuids))
+        return version
+
+    @staticmethod
+    def refresh_pending():
+        """Refresh the clients whose filters were written, each one in a single worker
+
+        A client stays pending until a refresh starts CATALOG_CHECK_INTERVAL seconds after
+        the last filter write, when no worker can save an agent with an older snapshot.
+        """
+        catalogdb = app.data.pymongo('client').db['catalog']
+        lease = settings.config.MEMBERSHIP_REFRESH_LEASE
+        seen = []
+        while True:
+            now = arrow.utcnow()
+            item = catalogdb.find_one_and_update(
+                {'_id': {'$nin': seen}, 'members_pending': True, 'members_lease': {'$not': {'$gt': now.datetime}}},
+                {'$set': {'members_lease': now.replace(seconds=+lease).datetime}},
+                return_document=ReturnDocument.AFTER)
+            if not item:
+                return
+            seen.append(item['_id'])
+            try:
+                client = Client(token=item['_id'])
+                version = FilterMembership.refresh(client) if client.token == item['_id'] and client.db() else None
+            except Exception:
+                # Retried by any worker once the lease expires
+                logger.exception("Filter membership refresh failed for %s", item['_id'])
+                continue
+
+            written = arrow.get(item['filters_updated']) if item.get('filters_updated') else now
+            settled = (now - written).total_seconds() > settings.config.CATALOG_CHECK_INTERVAL
+            # Done unless the filters were written again meanwhile
+            done = {'_id': item['_id']} if version is None else {'_id': item['_id'], 'filters': version}
+            result = catalogdb.update_one(done, {'$set': {'members_pending': False},
+                                                 '$unset': {'members_lease': ''}}) if settled else None
+            if not result or not result.matched_count:
+                catalogdb.update_one({'_id': item['_id']}, {'$unset': {'members_lease': ''}})
+
+    @staticmethod
+    def schedule_refresh(flask_app, interval):
+        """Run refresh_pending every interval seconds in the background"""
+
+        def refresh_membership():
+            with flask_app.app_context():
+                FilterMembership.refresh_pending()
+
+        job = Periodic(refresh_membership, interval)
+        job.start()
+        return job
+
+    # EVE hooks
+    @staticmethod
+    def eve_hook_insert_agent(items):
+        client = current_identity.get_client()
+        for item in items:
+            item.update(FilterMembership.compute(client, item))
+
+    @staticmethod
+    def eve_hook_update_agent(updates, original):
+        client = current_identity.get_client()
+        updates.update(FilterMembership.compute(client, dict(original, **updates)))
+
+    @staticmethod
+    def eve_hook_replace_agent(item, original):
+        client = current_identity.get_client()
+        item.update(FilterMembership.compute(client, item))
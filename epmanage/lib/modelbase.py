@@ -20,6 +20,8 @@ along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
 import arrow
 
+from epmanage.lib.lastseen import LastSeenBuffer
+
 
 class Model(object):
     def __init__(self, data, is_new):
@@ -76,6 +78,16 @@ class Model(object):
             self._modeldb.replace_one({'_id': self._data['_id']}, self._data)
             self._set_modified(False)
 
+    def touch(self):
+        """Update last_seen: saved now if there are other changes, buffered otherwise"""
+        now = arrow.utcnow().datetime
+        if self.is_new() or self.is_modified():
+            self._data['last_seen'] = now
+            self.save()
+        else:
+            self._data['last_seen'] = now
+            LastSeenBuffer().touch(self._modeldb, self._data['_id'], now)
+
     def prepare_data(self):
         pass
 
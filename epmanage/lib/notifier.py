@@ -0,0 +1,112 @@
+"""
+notifier.py : Task catalog change notifications for long-polling agents
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import threading
+
+from flask import current_app as app
+
+import epmanage.settings as settings
+from epmanage.lib.catalog import TaskCatalog, APPS_KEY
+from epmanage.utils import Singleton, Periodic
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogNotifier(metaclass=Singleton):
+    """Wake up the requests waiting for a change in the task catalog of a client
+
+    Each subscription keeps the catalog version it was made at. A watcher checks the
+    catalog versions of the clients with waiting requests every TASK_NOTIFY_INTERVAL
+    seconds, with a single query, and wakes the requests subscribed at another version.
+    Writes from any worker are seen, writes from this worker wake the requests at once.
+    Waiting costs an Event per client and version, with gevent workers it holds no thread.
+    The events of a client are dropped when its last waiting request leaves.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__events = dict()  # token -> {version: Event}, set and removed on change
+        self.__waiters = dict()  # token -> waiting requests
+        self.__app = None
+        self.__watcher = Periodic(self.__check, settings.config.TASK_NOTIFY_INTERVAL)
+
+    @staticmethod
+    def subscribe(token: str) -> tuple:
+        """Get the subscription to the next change, to be called before reading the catalog"""
+        # The catalog read next is at this version or a later one
+        snapshot = TaskCatalog().peek(token)
+        return snapshot.version if snapshot else TaskCatalog().get_version(token)
+
+    def wait(self, token: str, subscription: tuple, timeout: float) -> bool:
+        """Wait for a change after a subscription, returns True if the catalog has changed"""
+        with self.__lock:
+            if not self.__app:
+                self.__app = app._get_current_object()
+            # A change made since the subscription is seen by the next check
+            events = self.__events.setdefault(token, dict())
+            event = events.get(subscription)
+            if not event:
+                event = events[subscription] = threading.Event()
+            self.__waiters[token] = self.__waiters.get(token, 0) + 1
+        self.__watcher.start()
+        try:
+            return event.wait(timeout)
+        finally:
+            with self.__lock:
+                self.__waiters[token] -= 1
+                if not self.__waiters[token]:
+                    del self.__waiters[token]
+                    self.__events.pop(token, None)
+
+    def notify(self, token: str, version=None):
+        """Wake up the requests waiting on a client, those subscribed at another version if given"""
+        with self.__lock:
+            events = self.__events.get(token, dict())
+            fired = [events.pop(known) for known in list(events) if known != version]
+            if not events:
+                self.__events.pop(token, None)
+        for event in fired:
+            event.set()
+        return len(fired)
+
+    def notify_all(self):
+        """Wake up every waiting request, after a change shared by all the clients"""
+        with self.__lock:
+            tokens = list(self.__events.keys())
+        for token in tokens:
+            self.notify(token)
+
+    def __check(self):
+        with self.__lock:
+            tokens = list(self.__waiters.keys())
+        if not tokens:
+            return
+
+        with self.__app.app_context():
+            versions = {item['_id']: item.get('version', 0) for item in app.data.pymongo('client').db['catalog'].find(
+                {'_id': {'$in': tokens + [APPS_KEY]}})}
+            for token in tokens:
+                version = versions.get(token, 0), versions.get(APPS_KEY, 0)
+                snapshot = TaskCatalog().peek(token)
+                if self.notify(token, version):
+                    logger.debug("Task catalog of %s changed: %s", token, version)
+                    if snapshot and snapshot.version != version:
+                        TaskCatalog().invalidate(token)
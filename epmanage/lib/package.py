@@ -0,0 +1,259 @@
+"""
+package.py : Package files sending, with ranges and precompressed variants
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List
+
+from flask import request, Response, send_file
+
+import epmanage.settings as settings
+from epmanage.utils import Singleton
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Content encodings of the package variants, by preference
+ENCODINGS = ['zstd', 'gzip']
+
+
+def get_encodings() -> List[str]:
+    """Get the encodings this server can produce"""
+    return [encoding for encoding in ENCODINGS if encoding != 'zstd' or zstandard]
+
+
+def compress_file(encoding: str, src: str, dst: str):
+    """Write the encoded content of src to dst"""
+    with open(src, 'rb') as ifile, open(dst, 'wb') as ofile:
+        if encoding == 'gzip':
+            with gzip.GzipFile(fileobj=ofile, mode='wb', compresslevel=settings.config.PACKAGE_GZIP_LEVEL,
+                               mtime=0) as gzfile:
+                shutil.copyfileobj(ifile, gzfile, 1024 * 1024)
+        elif encoding == 'zstd' and zstandard:
+            zstandard.ZstdCompressor(level=settings.config.PACKAGE_ZSTD_LEVEL).copy_stream(ifile, ofile)
+        else:
+            raise ValueError("Unsupported encoding {}".format(encoding))
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as ifile:
+        for chunk in iter(lambda: ifile.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_variant_etag(etag: str, encoding: Optional[str]) -> str:
+    """ETag of an encoded representation of a package"""
+    return '{}-{}'.format(etag, encoding) if encoding else etag
+
+
+class Variant(object):
+    """Encoded file of a package"""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+
+
+class Package(object):
+    """Code package file with its strong ETag (sha256 of the content) and prebuilt variants"""
+
+    def __init__(self, path: str, size: int, etag: str, stat_key=None, variants=None):
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.stat_key = stat_key
+        self.variants = variants or dict()  # Encoding -> Variant
+
+    @classmethod
+    def from_file(cls, path: str, stat):
+        return cls(path, stat.st_size, file_sha256(path), (stat.st_mtime_ns, stat.st_size))
+
+
+class PackageJobs(metaclass=Singleton):
+    """Background thread for the package files made after the first request
+
+    A job is queued once per key until it is done, so the requests never wait for it.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__executor = None
+        self.__pid = None
+        self.__pending = set()
+
+    def __get_executor(self):
+        if not self.__executor or self.__pid != os.getpid():
+            self.__executor = ThreadPoolExecutor(max_workers=1)
+            self.__pid = os.getpid()
+            self.__pending.clear()
+        return self.__executor
+
+    def __run(self, key, func, args):
+        try:
+            func(*args)
+        except Exception:
+            logger.exception("Package job %s failed", key)
+        finally:
+            with self.__lock:
+                self.__pending.discard(key)
+
+    def submit(self, key, func, *args) -> bool:
+        """Queue func(*args) unless the job of key is already queued"""
+        with self.__lock:
+            executor = self.__get_executor()
+            if key in self.__pending:
+                return False
+            self.__pending.add(key)
+        executor.submit(self.__run, key, func, args)
+        return True
+
+
+class VariantCache(metaclass=Singleton):
+    """Variants of the packages compressed in the background after the first request
+
+    Files are named after the package sha256 and the encoding in PACKAGE_VARIANT_PATH, so
+    the workers share them and a new package version gets new files. The package is sent
+    as is until its variant exists. Variants which are not smaller than the package are
+    kept on disk but not served.
+    """
+
+    def __init__(self):
+        self.__variants = dict()  # (etag, encoding) -> Variant, None when not worth it
+
+    def __compress(self, key, package, encoding: str, path: str):
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.')
+        os.close(fd)
+        try:
+            compress_file(encoding, package.path, tmp_path)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except (OSError, ValueError):
+            logger.exception("Cannot compress %s with %s", package.path, encoding)
+            os.remove(tmp_path)
+            self.__variants[key] = None
+            return
+        logger.info("Compressed %s with %s", package.path, encoding)
+
+    def get(self, package, encoding: str) -> Optional[Variant]:
+        """Get the variant of a package, None until it is compressed"""
+        folder = settings.config.PACKAGE_VARIANT_PATH
+        if not folder or package.size < settings.config.PACKAGE_COMPRESS_MIN_SIZE:
+            return None
+        key = (package.etag, encoding)
+        if key in self.__variants:
+            return self.__variants[key]
+
+        path = os.path.join(folder, '{}.{}'.format(package.etag, encoding))
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            PackageJobs().submit(('variant',) + key, self.__compress, key, package, encoding, path)
+            return None
+        variant = Variant(path, size) if size < package.size else None
+        self.__variants[key] = variant
+        return variant
+
+
+def get_accepted_encodings() -> List[str]:
+    """Get the encodings accepted by the request, by quality then by preference"""
+    quality = request.accept_encodings.quality
+    return sorted((encoding for encoding in get_encodings() if quality(encoding) > 0),
+                  key=lambda encoding: -quality(encoding))
+
+
+def stream_range(path: str, start: int, length: int, chunk_size=64 * 1024):
+    """Read a part of a file in chunks"""
+    with open(path, 'rb') as ifile:
+        ifile.seek(start)
+        while length > 0:
+            chunk = ifile.read(min(length, chunk_size))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def send_package(package, mimetype: str, max_age: int, compress=True):
+    """Send a package file, with ETag, single Range support and Accept-Encoding negotiation
+
+    The package has path, size and etag (its sha256), and its prebuilt variants as an
+    encoding -> Variant dict. The other variants come from the VariantCache.
+    """
+    encodings = get_accepted_encodings() if compress else []
+
+    # Any representation still fresh at the client, without compressing anything
+    for encoding in encodings + [None]:
+        etag = get_variant_etag(package.etag, encoding)
+        if etag in request.if_none_match:
+            resp = Response(status=304)
+            resp.set_etag(etag)
+            resp.vary.add('Accept-Encoding')
+            return resp
+
+    encoding, path, size = None, package.path, package.size
+    for accepted in encodings:
+        variant = package.variants.get(accepted) or VariantCache().get(package, accepted)
+        if variant:
+            encoding, path, size = accepted, variant.path, variant.size
+            break
+    etag = get_variant_etag(package.etag, encoding)
+
+    # Ranges apply to the selected representation, and only to the same version of it
+    if_range = request.headers.get('If-Range')
+    byte_range = request.range if not if_range or if_range.strip('"') == etag else None
+    span = byte_range.range_for_length(size) if byte_range else None
+    if byte_range and not span and len(byte_range.ranges) > 1:
+        # Multiple ranges are not supported, send the whole representation
+        byte_range = None
+    if byte_range:
+        if not span:
+            # Only a single range out of the representation is unsatisfiable
+            resp = Response(status=416)
+            resp.headers['Content-Range'] = 'bytes */{}'.format(size)
+            return resp
+        start, stop = span
+        resp = Response(stream_range(path, start, stop - start), status=206, mimetype=mimetype,
+                        direct_passthrough=True)
+        resp.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+        resp.content_length = stop - start
+    else:
+        # File wrapper of the WSGI server, sendfile with gunicorn
+        resp = send_file(path, mimetype=mimetype, add_etags=False, conditional=False)
+    if encoding:
+        resp.content_encoding = encoding
+    resp.set_etag(etag)
+    resp.vary.add('Accept-Encoding')
+    resp.headers['Accept-Ranges'] = 'bytes'
+    resp.cache_control.max_age = max_age
+    return resp
@@ -0,0 +1,166 @@
+"""
+passwords.py : Password hashing worker pool
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import has_request_context, request
+from passlib.context import CryptContext
+from werkzeug.exceptions import ServiceUnavailable
+
+import epmanage.settings as settings
+from epmanage.utils import Singleton
+
+logger = logging.getLogger(__name__)
+
+pwdctx = CryptContext(schemes=["sha256_crypt"])
+
+
+def hash_password(password):
+    """Hash a password (runs in the pool)"""
+    return pwdctx.encrypt(password)
+
+
+def verify_password(password, hashed):
+    """Verify a password, returns (match, needs_update) (runs in the pool)"""
+    check = pwdctx.verify(password, hashed)
+    return check, check and pwdctx.needs_update(hashed)
+
+
+class HashPoolBusy(ServiceUnavailable):
+    """Raised (HTTP 503) when the password pool cannot take more work"""
+    description = "Too many authentication requests, please retry later"
+
+
+class PasswordHasher(metaclass=Singleton):
+    """Run password hashing in a process pool, so that it does not block the request workers
+
+    At most PASSWORD_POOL_MAX_QUEUE operations may wait or run at once in this process, and
+    at most PASSWORD_POOL_MAX_PER_SOURCE for a single remote address. Above that, requests
+    fail fast with HashPoolBusy.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__executor = None
+        self.__pid = None
+        self.__pending = 0
+        self.__sources = dict()
+        self.__stats = dict(count=0, rejected=0, errors=0, latency_total=0.0, latency_max=0.0)
+
+    def __get_executor(self):
+        with self.__lock:
+            if not self.__executor or self.__pid != os.getpid():
+                self.__executor = ProcessPoolExecutor(max_workers=settings.config.PASSWORD_POOL_WORKERS)
+                self.__pid = os.getpid()
+            return self.__executor
+
+    def __reset_executor(self):
+        with self.__lock:
+            if self.__executor:
+                self.__executor.shutdown(wait=False)
+            self.__executor = None
+
+    @staticmethod
+    def __get_source():
+        return request.remote_addr if has_request_context() else None
+
+    def __acquire(self, source):
+        with self.__lock:
+            if self.__pending >= settings.config.PASSWORD_POOL_MAX_QUEUE or \
+                    self.__sources.get(source, 0) >= settings.config.PASSWORD_POOL_MAX_PER_SOURCE:
+                self.__stats['rejected'] += 1
+                logger.warning("Password pool busy: %d pending, %d from %s",
+                               self.__pending, self.__sources.get(source, 0), source)
+                raise HashPoolBusy()
+            self.__pending += 1
+            self.__sources[source] = self.__sources.get(source, 0) + 1
+
+    def __count_error(self):
+        with self.__lock:
+            self.__stats['errors'] += 1
+
+    def __release(self, source, latency):
+        with self.__lock:
+            self.__pending -= 1
+            self.__sources[source] -= 1
+            if not self.__sources[source]:
+                del self.__sources[source]
+            self.__stats['count'] += 1
+            self.__stats['latency_total'] += latency
+            self.__stats['latency_max'] = max(self.__stats['latency_max'], latency)
+
+    def __run(self, func, *args):
+        source = self.__get_source()
+        self.__acquire(source)
+        start = time.monotonic()
+
+        def release(*_):
+            latency = time.monotonic() - start
+            self.__release(source, latency)
+            logger.debug("Password operation took %.3fs", latency)
+
+        if not settings.config.PASSWORD_POOL_WORKERS:
+            try:
+                return func(*args)
+            finally:
+                release()
+
+        try:
+            future = self.__get_executor().submit(func, *args)
+        except BrokenProcessPool:
+            release()
+            logger.exception("Password pool failure")
+            self.__count_error()
+            self.__reset_executor()
+            raise HashPoolBusy()
+        # The slot is held until the operation ends in the pool, even after a timeout
+        future.add_done_callback(release)
+        try:
+            return future.result(timeout=settings.config.PASSWORD_POOL_TIMEOUT)
+        except TimeoutError:
+            logger.error("Password operation timed out")
+            self.__count_error()
+            raise HashPoolBusy()
+        except BrokenProcessPool:
+            logger.exception("Password pool failure")
+            self.__count_error()
+            self.__reset_executor()
+            raise HashPoolBusy()
+
+    def hash(self, password):
+        """Hash a password"""
+        return self.__run(hash_password, password)
+
+    def verify(self, password, hashed):
+        """Verify a password, returns (match, needs_update)"""
+        return self.__run(verify_password, password, hashed)
+
+    def get_stats(self):
+        """Get the pool metrics of this process"""
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats['pending'] = self.__pending
+            stats['latency_avg'] = stats['latency_total'] / stats['count'] if stats['count'] else 0.0
+        return stats
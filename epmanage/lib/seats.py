@@ -0,0 +1,200 @@
+"""
+seats.py : Licensed seats counters
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import os
+import socket
+
+import arrow
+from flask import current_app as app
+from pymongo.errors import DuplicateKeyError
+
+import epmanage.lib.auth
+from epmanage.lib.client import Client
+from epmanage.utils import Periodic
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_AGENTS_QUERY = {'tags.name': {'$nin': ['disabled']}}
+
+
+def is_active_agent(data: dict) -> bool:
+    """Check if an agent document uses a licensed seat"""
+    return not any(tag.get('name') == 'disabled' for tag in data.get('tags') or [])
+
+
+def is_active_user(data: dict) -> bool:
+    """Check if a user document uses a licensed seat"""
+    return bool(data.get('roles'))
+
+
+class SeatCounter(object):
+    """Active agents and users per client, one document per client in the global seats collection
+
+    The counters are updated with $inc when an agent or a user is enabled, disabled, created
+    or deleted. reconcile() counts the real values again to correct any drift.
+    """
+
+    @staticmethod
+    def __db():
+        return app.data.pymongo('client').db['seats']
+
+    @staticmethod
+    def get(client) -> dict:
+        """Get the counters of a client"""
+        seats = SeatCounter.__db().find_one({'_id': client.token})
+        if not seats:
+            seats = SeatCounter.reconcile(client)
+        return seats
+
+    @staticmethod
+    def get_agents(client) -> int:
+        return SeatCounter.get(client).get('agents', 0)
+
+    @staticmethod
+    def get_users(client) -> int:
+        return SeatCounter.get(client).get('users', 0)
+
+    @staticmethod
+    def inc(token: str, agents=0, users=0):
+        """Add to the counters of a client, once the change is written"""
+        if not token or not (agents or users):
+            return
+        result = SeatCounter.__db().update_one({'_id': token}, {'$inc': dict(agents=agents, users=users)})
+        if not result.matched_count:
+            # No counters yet, they will be created from the current state on next read
+            logger.debug("No seats counters for %s", token)
+
+    @staticmethod
+    def count_agents(client) -> int:
+        return client.db()['agent'].count(ACTIVE_AGENTS_QUERY)
+
+    @staticmethod
+    def count_users(client) -> int:
+        userdb = app.data.pymongo('user').db['user']
+        return userdb.count({'client': client.token, 'roles': {'$gt': []}})
+
+    @staticmethod
+    def reconcile(client) -> dict:
+        """Count the active agents and users of a client and store the result
+
+        The counters are only replaced if no $inc was applied while counting, otherwise
+        they are left for the next reconcile.
+        """
+        db = SeatCounter.__db()
+        previous = db.find_one({'_id': client.token})
+        seats = dict(
+            _id=client.token,
+            agents=SeatCounter.count_agents(client),
+            users=SeatCounter.count_users(client))
+        if not previous:
+            try:
+                db.insert_one(seats)
+            except DuplicateKeyError:
+                # Created by another request meanwhile
+                return db.find_one({'_id': client.token})
+            return seats
+        if previous.get('agents') == seats['agents'] and previous.get('users') == seats['users']:
+            return seats
+
+        result = db.update_one(
+            {'_id': client.token, 'agents': previous.get('agents'), 'users': previous.get('users')},
+            {'$set': dict(agents=seats['agents'], users=seats['users'])})
+        if not result.modified_count:
+            logger.info("Seats counters of %s changed while counting, reconcile skipped", client.token)
+            return db.find_one({'_id': client.token})
+        logger.warning("Seats counters drift for %s: %s/%s agents, %s/%s users", client.token,
+                       previous.get('agents'), seats['agents'], previous.get('users'), seats['users'])
+        return seats
+
+    @staticmethod
+    def acquire_lease(interval) -> bool:
+        """Take the reconcile lease for interval seconds, so that one worker reconciles"""
+        now = arrow.utcnow()
+        try:
+            app.data.pymongo('client').db['lease'].find_one_and_update(
+                {'_id': 'seats', 'until': {'$lte': now.datetime}},
+                {'$set': {'until': now.replace(seconds=+interval).datetime,
+                          'owner': '{}:{}'.format(socket.gethostname(), os.getpid())}},
+                upsert=True)
+        except DuplicateKeyError:
+            # The lease is held by another worker
+            return False
+        return True
+
+    @staticmethod
+    def reconcile_all():
+        """Reconcile the counters of every client"""
+        clientdb = app.data.pymongo('client').db['client']
+        for item in clientdb.find({'token': {'$exists': True}}, {'token': True}):
+            client = Client(token=item['token'])
+            if client.db():
+                SeatCounter.reconcile(client)
+
+    @staticmethod
+    def schedule_reconcile(flask_app, interval):
+        """Run reconcile_all every interval seconds in the background, in one worker at a time"""
+
+        def reconcile_seats():
+            with flask_app.app_context():
+                if SeatCounter.acquire_lease(interval):
+                    SeatCounter.reconcile_all()
+
+        job = Periodic(reconcile_seats, interval)
+        job.start()
+        return job
+
+    # EVE hooks, for agents and users written through the API
+    @staticmethod
+    def __get_token():
+        client = epmanage.lib.auth.current_identity.get_client()
+        return client.token if client else None
+
+    @staticmethod
+    def eve_hook_inserted_agent(items):
+        SeatCounter.inc(SeatCounter.__get_token(), agents=sum(1 for item in items if is_active_agent(item)))
+
+    @staticmethod
+    def eve_hook_updated_agent(updates, original):
+        before = is_active_agent(original)
+        after = is_active_agent(dict(original, **updates))
+        SeatCounter.inc(SeatCounter.__get_token(), agents=int(after) - int(before))
+
+    @staticmethod
+    def eve_hook_deleted_agent(item):
+        if is_active_agent(item):
+            SeatCounter.inc(SeatCounter.__get_token(), agents=-1)
+
+    @staticmethod
+    def eve_hook_inserted_user(items):
+        for item in items:
+            if is_active_user(item):
+                SeatCounter.inc(item.get('client'), users=1)
+
+    @staticmethod
+    def eve_hook_updated_user(updates, original):
+        before = is_active_user(original)
+        after = is_active_user(dict(original, **updates))
+        SeatCounter.inc(original.get('client'), users=int(after) - int(before))
+
+    @staticmethod
+    def eve_hook_deleted_user(item):
+        if is_active_user(item):
+            SeatCounter.inc(item.get('client'), users=-1)
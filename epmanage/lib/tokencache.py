@@ -0,0 +1,115 @@
+"""
+tokencache.py : Verified agent tokens cache
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+import threading
+import time
+
+import epmanage.settings as settings
+from epmanage.utils import Singleton, LRUCache
+
+
+class TokenCache(metaclass=Singleton):
+    """Verified agent token claims and agent snapshot, keyed by token digest
+
+    Entries live until the token expires or AUTH_TOKEN_CACHE_TTL, whichever comes first.
+    The cache is per process: evictions do not reach the other workers, the TTL bounds
+    how long they can serve a stale snapshot. An agent uuid -> digests index makes the
+    evictions independent of the cache size.
+    """
+
+    def __init__(self):
+        self.__cache = LRUCache(settings.config.AUTH_TOKEN_CACHE_SIZE)
+        self.__lock = threading.Lock()
+        self.__agents = dict()  # uuid -> digests, may hold entries the cache dropped
+        self.__indexed = 0  # Digests in the index, at most twice the cache size
+
+    @staticmethod
+    def __digest(raw_token: str):
+        return hashlib.sha256(raw_token.encode()).digest()
+
+    def get(self, raw_token: str):
+        """Get the (claims, snapshot) for a token, None if not cached"""
+        return self.__cache.get(self.__digest(raw_token))
+
+    def set(self, raw_token: str, claims: dict, snapshot: dict):
+        expire = min(claims['exp'] - time.time(), settings.config.AUTH_TOKEN_CACHE_TTL)
+        if expire <= 0:
+            return
+        digest = self.__digest(raw_token)
+        self.__cache.set(digest, (claims, snapshot), expire=expire)
+        with self.__lock:
+            digests = self.__agents.setdefault(snapshot.get('uuid'), set())
+            if digest not in digests:
+                digests.add(digest)
+                self.__indexed += 1
+                if self.__indexed > 2 * self.__cache.maxsize:
+                    self.__compact()
+
+    def __compact(self):
+        """Drop the index entries of the tokens the cache no longer holds"""
+        keys = set(self.__cache.keys())
+        self.__indexed = 0
+        for uuid, digests in list(self.__agents.items()):
+            digests &= keys
+            if digests:
+                self.__indexed += len(digests)
+            else:
+                del self.__agents[uuid]
+
+    def evict_agent(self, uuid: str):
+        """Drop every cached token of an agent"""
+        return self.evict_agents({uuid})
+
+    def evict_agents(self, uuids: set):
+        """Drop every cached token of several agents"""
+        count = 0
+        with self.__lock:
+            digests = [digest for uuid in uuids for digest in self.__agents.pop(uuid, ())]
+            self.__indexed -= len(digests)
+        for digest in digests:
+            if self.__cache.pop(digest) is not None:
+                count += 1
+        return count
+
+    def clear(self):
+        self.__cache.clear()
+        with self.__lock:
+            self.__agents.clear()
+            self.__indexed = 0
+
+
+class IssuedTokens(metaclass=Singleton):
+    """Last token issued to each agent, for AUTH_TOKEN_REUSE
+
+    Raw tokens are bearer credentials, they are only kept in the memory of the process
+    which issued them. Agents served by another worker get a new token there.
+    """
+
+    def __init__(self):
+        self.__cache = LRUCache(settings.config.AUTH_TOKEN_CACHE_SIZE)
+
+    def get(self, uuid: str):
+        """Get the token last issued to an agent by this process, None if unknown or expired"""
+        return self.__cache.get(uuid)
+
+    def set(self, uuid: str, raw_token: str, expire: float):
+        if expire > 0:
+            self.__cache.set(uuid, raw_token, expire=expire)
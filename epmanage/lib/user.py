@@ -31,11 +31,12 @@ import pyotp
 from emails.template import JinjaTemplate as T
 from flask import abort, current_app as app
 from flask.ext.emails import Message
-from passlib.context import CryptContext
 
 import epmanage.lib.auth
 from epmanage.lib.client import Client
 from epmanage.lib.modelbase import Model
+from epmanage.lib.passwords import PasswordHasher
+from epmanage.lib.seats import SeatCounter, is_active_user
 
 logger = logging.getLogger(__name__)
 RESET_TOKEN_LEN = 32
@@ -43,7 +44,6 @@ RESET_TOKEN_LEN = 32
 
 class User(Model):
     """User object (CMI user)"""
-    __pwdctx = CryptContext(schemes=["sha256_crypt"])
 
     @classmethod
     def from_email(cls, email: str):
@@ -75,6 +75,7 @@ class User(Model):
             data = dict()
             is_new = True
         super(User, self).__init__(data, is_new)
+        super(User, self).__setattr__('_was_active', not is_new and is_active_user(data))
 
         for key, value in kwargs.items():
             if key != 'password':
@@ -102,12 +103,11 @@ class User(Model):
         if 'roles' in self._data:
             self._data['roles'].sort()
 
-            # Enforce active users
+            # Enforce active users when the user takes a seat
             client = self.get_client()
-            if client:
-                active = User.get_active_users(client)
+            if client and is_active_user(self._data) and not self._was_active:
                 max_users = client.max_users
-                if max_users and active >= max_users:
+                if max_users and SeatCounter.get_users(client) >= max_users:
                     logger.info("Client cap exceded: forcing empty roles (user disabled) for (%s)", self.email)
 
                     # Add an error if the user already exists
@@ -115,6 +115,13 @@ class User(Model):
                         self.add_error("Client cap exceded: forcing empty roles (user disabled) for (%s)" % self.email)
                     self._data['roles'] = []
 
+    def save(self):
+        super(User, self).save()
+        active = is_active_user(self._data)
+        if active != self._was_active:
+            SeatCounter.inc(self.client, users=1 if active else -1)
+            super(User, self).__setattr__('_was_active', active)
+
     def check_password(self, password):
         """Check the password"""
         if not self._data.get('_password'):
@@ -122,8 +129,8 @@ class User(Model):
 
         hashed = self._data.get('_password')
         try:
-            check = User.__pwdctx.verify(password, hashed)
-            if check and User.__pwdctx.needs_update(hashed):
+            check, needs_update = PasswordHasher().verify(password, hashed)
+            if needs_update:
                 if self.change_password(password):
                     logger.debug("Password for (%s) has been upgraded", self.email)
                     self.save()
@@ -142,7 +149,7 @@ class User(Model):
                 return False
             del self._data['_reset_token']
             logger.info("Password reset for (%s)", self.email)
-        self._data['_password'] = User.__pwdctx.encrypt(password)
+        self._data['_password'] = PasswordHasher().hash(password)
         self._set_modified(True)
         if 'password' in self._data:
             del self._data['password']
@@ -245,14 +252,6 @@ class User(Model):
         return True
 
     # EVE filter callbacks
-    @staticmethod
-    def get_active_users(client: Client = None):
-        userdb = app.data.pymongo('user').db['user']
-        if not client:
-            identity = epmanage.lib.auth.current_identity
-            client = identity.get_client()
-        return userdb.count({'client': client.token, 'roles': {'$gt': []}})
-
     @staticmethod
     def eve_hook_write_user(item, original=None):
         identity = epmanage.lib.auth.current_identity
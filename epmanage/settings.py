@@ -65,10 +65,28 @@ class Config(object):
     # Crypto config
     AUTH_PRIVKEY = os.path.join(BASE_PATH, 'pki/auth_priv.pem')
     AUTH_PUBKEY = os.path.join(BASE_PATH, 'pki/auth_pub.pem')
+    # Additional public keys (*.pem) accepted for token verification, used for key rotation
+    AUTH_PUBKEYS_PATH = os.path.join(BASE_PATH, 'pki/pub.d')
+    AUTH_KEY_CHECK_INTERVAL = 10  # Seconds between two checks for key files changes
+    # Algorithm for new tokens (RS512, ES256 or EdDSA), must match the AUTH_PRIVKEY key type
+    AUTH_ALGORITHM = 'RS512'
+    # Algorithms accepted when verifying tokens, keep the previous one while migrating
+    AUTH_ALGORITHMS = ['RS512', 'ES256', 'EdDSA']
 
     # ------------------------------------------------------------------------------
     # Auth config
     TOKEN_RENEW_GRACE = 60  # 1 minute after expiration
+    AUTH_TOKEN_CACHE_SIZE = 20000  # Verified agent tokens kept per process
+    AUTH_TOKEN_CACHE_TTL = 30  # Seconds before a cached agent token is verified again
+    LAST_SEEN_FLUSH_INTERVAL = 30  # Max seconds before a last_seen heartbeat is written
+    LAST_SEEN_MAX_PENDING = 5000  # Flush earlier when this many heartbeats are pending
+    # Agents get their current token back from the worker which issued it, while this share of its lifetime is left
+    AUTH_TOKEN_REUSE = 0.5
+    # Password hashing runs in a process pool (0 workers: on the request thread)
+    PASSWORD_POOL_WORKERS = 2
+    PASSWORD_POOL_MAX_QUEUE = 16  # Pending operations per process before answering 503
+    PASSWORD_POOL_MAX_PER_SOURCE = 2  # Pending operations per remote address
+    PASSWORD_POOL_TIMEOUT = 10  # Seconds
 
     # ------------------------------------------------------------------------------
     # Storage config
@@ -80,6 +98,21 @@ class Config(object):
     TASKS_PATH = os.path.join(BASE_PATH, 'tasks')
     ASSETS_PATH = os.path.join(APP_ROOT, 'assets')
     LOG_FILE = os.path.join(APP_ROOT, 'logs/app.log')
+    MANIFEST_CHECK_INTERVAL = 10  # Seconds before the manifest files are checked for changes
+    # Prebuilt manifests and packages (python -m epmanage.code.bundle), None to build them on the fly
+    BUNDLE_PATH = None
+    # Compressed packages and installers made on first request, None to disable
+    PACKAGE_VARIANT_PATH = os.path.join(BASE_PATH, 'variants')
+    PACKAGE_COMPRESS_MIN_SIZE = 1024  # Bytes, smaller files are always sent as is
+    PACKAGE_GZIP_LEVEL = 9
+    PACKAGE_ZSTD_LEVEL = 19  # zstd needs the zstandard package
+    # Deltas between package versions (needs the bsdiff4 package), None to disable
+    PACKAGE_DELTA_PATH = os.path.join(BASE_PATH, 'deltas')
+    PACKAGE_HISTORY_PATH = os.path.join(BASE_PATH, 'history')  # Prior versions, without a bundle
+    PACKAGE_DELTA_HISTORY = 3  # Prior versions kept per package
+    PACKAGE_DELTA_CACHE_SIZE = 1024 ** 3  # Bytes of deltas kept on disk
+    PACKAGE_DELTA_MAX_SIZE = 64 * 1024 ** 2  # Bytes, bigger packages are always sent in full
+    PACKAGE_DELTA_MAX_RATIO = 0.5  # Deltas bigger than this part of the package are not sent
 
     # ------------------------------------------------------------------------------
     # Cache config
@@ -88,13 +121,30 @@ class Config(object):
         'default_expiration': 86400,
         'eviction_policy': 'least-recently-stored'
     }
+    CLIENT_CACHE_SIZE = 10000  # Client documents kept per process
+    CLIENT_CACHE_TTL = 300  # Seconds before a cached client document is read again
+    CATALOG_CACHE_SIZE = 1000  # Client task catalogs kept per process
+    CATALOG_CHECK_INTERVAL = 2  # Max seconds before a catalog change reaches all the workers
+    TASK_PLAN_CACHE_SIZE = 50000  # Agent task plans kept per process
+    MEMBERSHIP_REFRESH_INTERVAL = 5  # Seconds between two checks for filter membership to refresh
+    MEMBERSHIP_REFRESH_LEASE = 600  # Seconds a worker holds a client refresh before another may retry
+    # Long-polling on /task/ (needs the gevent workers, see etc/gunicorn.conf)
+    TASK_LONGPOLL_TIMEOUT = 60  # Max seconds a request waits for a change, 0 to disable
+    TASK_LONGPOLL_JITTER = 10  # Random seconds taken off the wait, to spread the polls again
+    TASK_NOTIFY_INTERVAL = 1  # Seconds between two checks for catalog changes
 
     # ------------------------------------------------------------------------------
     # Database config
     MONGO_HOST = '127.0.0.1'
     MONGO_PORT = 27017
     MONGO_DBNAME = 'epmanage'
+    # Client databases share one connection pool per host, port and credentials
+    MONGO_POOL_MAX_SIZE = 100
+    MONGO_POOL_MIN_SIZE = 0
+    MONGO_POOL_MAX_IDLE_TIME = 60  # Seconds before an idle connection is closed
     ELASTIC_HOSTS = [{'host': '127.0.0.1', 'port': 9200}]
+    ELASTIC_BULK_SIZE = 500  # Report lines per bulk request
+    ELASTIC_BULK_MAX_BYTES = 5 * 1024 ** 2  # Bytes per bulk request
 
     # ------------------------------------------------------------------------------
     # Eve specific config
@@ -130,6 +180,7 @@ class Config(object):
     ALLOWED_WRITE_ROLES = ['urn:cmi_rw', 'urn:cmi_admin']
     INVITE_MAX_AGENTS = 20
     INVITE_MAX_USERS = 20
+    SEATS_RECONCILE_INTERVAL = 3600  # Seconds between two recounts of the licensed seats, 0 to disable
 
     # ------------------------------------------------------------------------------
     # Swagger config
@@ -193,6 +244,10 @@ class Config(object):
 
         self.__clientdb = None
 
+        # Client database settings by token
+        from epmanage.utils.lru import LRUCache
+        self.__database_settings = LRUCache(self.CLIENT_CACHE_SIZE, self.CLIENT_CACHE_TTL)
+
     def get(self, item, default=None):
         special = self.get_special_var(item)
         if special:
@@ -231,17 +286,35 @@ class Config(object):
             setattr(self, key, default)
 
     def get_special_var(self, item: str):
+        # Fast path for the ordinary keys
+        if not item.startswith('MONGOCLIENT_'):
+            return None
         match = MONGO_CONFIG_VAR.match(item)
         if match:
+            database_settings = self.get_database_settings(match.group(1))
+            if database_settings is not None:
+                return database_settings.get(match.group(2), self.get('MONGO_{}'.format(match.group(2))))
+        return None
+
+    def get_database_settings(self, token: str):
+        """Get the database settings of a client, None if the client does not exist"""
+        database_settings = self.__database_settings.get(token)
+        if database_settings is None:
             if not self.__clientdb:
                 from flask import current_app as app
                 self.__clientdb = app.data.pymongo('client').db['client']
                 if not self.__clientdb:
                     return None
-            client = self.__clientdb.find_one({'token': match.group(1)})
-            if client:
-                return client['database_settings'].get(match.group(2), self.get('MONGO_{}'.format(match.group(2))))
-        return None
+            client = self.__clientdb.find_one({'token': token}, {'database_settings': True})
+            if not client:
+                return None
+            database_settings = client['database_settings']
+            self.__database_settings.set(token, database_settings)
+        return database_settings
+
+    def invalidate_database_settings(self, token: str):
+        """Forget the cached database settings of a client"""
+        self.__database_settings.pop(token)
 
 
 class DebugConfig(Config):
@@ -18,9 +18,14 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
-from flask import Blueprint, request, jsonify
+import random
+import time
 
+from flask import Blueprint, Response, request, jsonify, abort
+
+from epmanage import settings
 from epmanage.lib.auth import auth_required, current_identity
+from epmanage.lib.notifier import CatalogNotifier
 from epmanage.task.task_controller import TaskController
 
 task_component = Blueprint('task_component', __name__)
@@ -29,10 +34,56 @@ task_component = Blueprint('task_component', __name__)
 @task_component.route('/', methods=['POST'])
 @auth_required('urn:task')
 def task_get():
-    """Get tasks to do"""
+    """Get tasks to do
+
+    With If-None-Match set to the current plan ETag and ?wait=<seconds>, the request is
+    held until the task catalog of the client changes or the wait expires.
+    With ?config_refs=1, configs are referenced by hash, see task_get_config.
+    """
     current_report = request.json
 
     task_controller = TaskController()
     agent = current_identity
-    tasks = task_controller.get_tasks(agent, current_report)
-    return jsonify(tasks)
+    client = agent.get_client()
+    references = request.args.get('config_refs', 0, type=int) > 0
+    wait = min(request.args.get('wait', 0, type=int), settings.config.TASK_LONGPOLL_TIMEOUT)
+    subscription = CatalogNotifier().subscribe(client.token) if client and wait > 0 else None
+
+    plan = task_controller.get_plan(agent, current_report, references)
+    if not plan:
+        return jsonify(None)
+
+    if subscription and plan.etag in request.if_none_match:
+        deadline = time.monotonic() + wait - random.uniform(0, min(wait, settings.config.TASK_LONGPOLL_JITTER))
+        while plan.etag in request.if_none_match:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not CatalogNotifier().wait(client.token, subscription, remaining):
+                break
+            subscription = CatalogNotifier().subscribe(client.token)
+            plan = task_controller.get_plan(agent, current_report, references)
+            if not plan:
+                return jsonify(None)
+
+    if plan.etag in request.if_none_match:
+        resp = Response(status=304)
+    else:
+        resp = Response(response=plan.body, status=200, mimetype='application/json')
+    resp.set_etag(plan.etag)
+    return resp
+
+
+@task_component.route('/config/<config_hash>', methods=['GET'])
+@auth_required('urn:task')
+def task_get_config(config_hash):
+    """Get a config by content hash, the body of a hash never changes"""
+    payload = TaskController().get_config_payload(current_identity, config_hash)
+    if payload is None:
+        abort(404)
+    if config_hash in request.if_none_match:
+        resp = Response(status=304)
+    else:
+        resp = Response(response=payload, status=200, mimetype='application/json')
+    resp.set_etag(config_hash)
+    resp.cache_control.private = True
+    resp.cache_control.max_age = 3600 * 24 * 365
+    return resp
@@ -18,28 +18,99 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
+import hashlib
 import json
 import logging
+import os
 from pathlib import Path
 from typing import Optional
 
-from epmanage.lib.app import App
+from flask import json as flask_json
+
+import epmanage.settings as settings
 from epmanage.lib.auth import Identity
-from epmanage.lib.filter import Filter
+from epmanage.lib.catalog import TaskCatalog, CatalogSnapshot
 from epmanage.settings import Config
+from epmanage.utils import Singleton, LRUCache
+
+# Agent fields that filters can reference, and the filter membership
+PLAN_FIELDS = ['uuid', 'hostname', 'os', 'osversion', 'ostype', '_filters', '_filters_version']
+
+
+class TaskPlan(object):
+    """Serialized task plan of an agent with its strong ETag"""
+
+    def __init__(self, data: dict):
+        self.body = flask_json.dumps(data).encode()
+        self.etag = hashlib.sha256(self.body).hexdigest()
+
+
+class TaskPlanCache(metaclass=Singleton):
+    """Last task plan of each agent, valid while its key does not change
+
+    The key holds the catalog version, the agent fields used by the filters and the
+    mtime of the task override file.
+    """
+
+    def __init__(self):
+        self.__cache = LRUCache(settings.config.TASK_PLAN_CACHE_SIZE)
+
+    def get(self, token: str, uuid: str, key: tuple) -> Optional[TaskPlan]:
+        item = self.__cache.get((token, uuid))
+        if item and item[0] == key:
+            return item[1]
+        return None
+
+    def set(self, token: str, uuid: str, key: tuple, plan: TaskPlan):
+        self.__cache.set((token, uuid), (key, plan))
 
 
 class TaskController(object):
     """Frontend logic"""
 
-    def __init__(self):
-        self.actiondb = None
+    @staticmethod
+    def __get_override(agent: Identity) -> Path:
+        return Path(Config().TASKS_PATH) / agent['uuid']
 
-    def get_tasks(self, agent: Identity, report: dict) -> Optional[dict]:
+    def get_plan(self, agent: Identity, report: dict, references=False) -> Optional[TaskPlan]:
+        """
+        Get the serialized tasks for the specified agent, from the cache if nothing changed
+        :param agent: the agent Identity
+        :param report: report from the endpoint (running tasks)
+        :param references: reference the configs by content hash instead of embedding them
+        """
+        if not agent:
+            return None
+        client = agent.get_client()
+        if not client:
+            return None
+        snapshot = TaskCatalog().get(client)
+
+        try:
+            override_mtime = os.stat(str(self.__get_override(agent))).st_mtime_ns
+        except OSError:
+            override_mtime = None
+        key = (snapshot.version, override_mtime, references,
+               tuple(str(agent[field]) for field in PLAN_FIELDS),
+               tuple(sorted(tag.get('name') or '' for tag in agent['tags'] or [])))
+
+        plan = TaskPlanCache().get(client.token, agent['uuid'], key)
+        if not plan:
+            tasks = self.get_tasks(agent, report, snapshot, references)
+            if tasks is None:
+                return None
+            plan = TaskPlan(tasks)
+            TaskPlanCache().set(client.token, agent['uuid'], key, plan)
+        return plan
+
+    def get_tasks(self, agent: Identity, report: dict, snapshot: CatalogSnapshot = None,
+                  references=False) -> Optional[dict]:
         """
         Get the tasks for the specified agent
         :param agent: the agent Identity
         :param report: report from the endpoint (running tasks)
+        :param snapshot: catalog snapshot of the agent client
+        :param references: reference the configs by content hash instead of embedding them
         """
         if not agent:
             return None
@@ -48,58 +119,37 @@ class TaskController(object):
             report = dict()
 
         # TODO: Use report
-        logging.info("Report from %s : %s", agent.get_agent().uuid, report)
+        logging.info("Report from %s : %s", agent['uuid'], report)
 
         data = dict(
             active=dict(),
             stop=[],
         )
 
-        if not self.actiondb:
-            self.actiondb = agent.get_client().db()['action']
-
-        tasks = dict()
-
-        for action in self.actiondb.find():
-            flt = Filter(name=action['filter'])
-            app = App(uappid=action['app_id'])
-            if flt.is_new() or app.is_new() or not flt.is_applicable(agent):
-                continue
-            if app.name not in tasks:
-                tasks[app.name] = dict(
-                    app=app.name,
-                    module='{module}.{module}'.format(module=app.name),
-                    configs=[]
-                )
-            config = app.get_config(action.get('config'))
-            if config is None:
-                continue
-
-            schedule = config.pop('schedule', None)
-            if schedule and schedule in ['daily', 'weekly', 'monthly']:
-                schedule = dict(
-                    type='period',
-                    value1=schedule
-                )
-            if action.get('schedule'):
-                schedule = action.get('schedule')
-
-            config['_schedule'] = schedule
-            config['task_id'] = str(action['_id'])
-
-            if config is not None:
-                tasks[app.name]['configs'].append(config)
+        if not snapshot:
+            client = agent.get_client()
+            if not client:
+                return None
+            snapshot = TaskCatalog().get(client)
+        tasks = snapshot.get_tasks(agent, references)
 
         for name, task in tasks.items():
             data['active'][name] = task
 
-        task_override = Path(Config().TASKS_PATH) / agent.get_agent().uuid
+        task_override = self.__get_override(agent)
         if task_override.exists():
             try:
                 data.update(json.load(task_override.open()))
             except:
                 pass
 
-        logging.debug("Tasks for %s : %s", agent.get_agent().uuid, data)
+        logging.debug("Tasks for %s : %s", agent['uuid'], data)
 
         return data
+
+    def get_config_payload(self, agent: Identity, config_hash: str) -> Optional[bytes]:
+        """Get a serialized config referenced in the task plans of the agent client"""
+        client = agent.get_client() if agent else None
+        if not client:
+            return None
+        return TaskCatalog().get(client).payloads.get(config_hash)
@@ -1,6 +1,9 @@
 from .utils import Singleton, cors, bytes2human, human2bytes
 from .cache import Cache
+from .keyring import KeyRing
+from .lru import LRUCache
+from .periodic import Periodic
 from .mongo import Mongo
 from .validator import CustomValidator
 
-__all__ = ['Singleton', 'cors', 'Cache', 'Mongo', 'bytes2human', 'human2bytes', 'CustomValidator']
+__all__ = ['Singleton', 'cors', 'Cache', 'KeyRing', 'LRUCache', 'Periodic', 'Mongo', 'bytes2human', 'human2bytes', 'CustomValidator']
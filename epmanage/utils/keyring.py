@@ -0,0 +1,144 @@
+"""
+keyring.py : Parsed token signing keys
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import glob
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from cryptography.exceptions import UnsupportedAlgorithm
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+import epmanage.settings as settings
+from epmanage.utils import Singleton
+
+logger = logging.getLogger(__name__)
+
+
+def get_key_id(key) -> str:
+    """Get the key id (kid) of a key: a fingerprint of its public part"""
+    if hasattr(key, 'private_bytes'):
+        key = key.public_key()
+    der = key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo)
+    return hashlib.sha256(der).hexdigest()[:16]
+
+
+class KeyFile(object):
+    """A PEM key file, parsed again only when it changes on disk"""
+
+    def __init__(self, path: str, private=False):
+        self.path = path
+        self.private = private
+        self.key = None
+        self.kid = None
+        self.__stamp = None
+
+    def refresh(self):
+        """Reload the key if the file has changed, returns the last valid key"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            logger.error("Cannot find key file %s", self.path)
+            return self.key
+
+        stamp = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if stamp == self.__stamp:
+            return self.key
+
+        try:
+            with open(self.path, 'rb') as ifile:
+                data = ifile.read()
+            if self.private:
+                key = serialization.load_pem_private_key(data, password=None, backend=default_backend())
+            else:
+                key = serialization.load_pem_public_key(data, backend=default_backend())
+        except (OSError, ValueError, TypeError, UnsupportedAlgorithm):
+            # Keep the previous key, the file may be in the middle of a rewrite
+            logger.error("Cannot load key file %s", self.path)
+            return self.key
+
+        self.key = key
+        self.kid = get_key_id(key)
+        self.__stamp = stamp
+        logger.info("Loaded key %s from %s", self.kid, self.path)
+        return self.key
+
+
+class KeyRing(metaclass=Singleton):
+    """Signing key and active verification keys, loaded once per process
+
+    Verification keys are AUTH_PUBKEY plus every *.pem in AUTH_PUBKEYS_PATH, selected by
+    the kid header of the token. Files are checked for changes at most every
+    AUTH_KEY_CHECK_INTERVAL seconds and only changed files are parsed again.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__signing = None
+        self.__files = dict()
+        self.__pubkeys = dict()
+        self.__next_check = 0
+
+    def __refresh(self):
+        now = time.monotonic()
+        if now < self.__next_check:
+            return
+        with self.__lock:
+            if now < self.__next_check:
+                return
+
+            if not self.__signing or self.__signing.path != settings.config.AUTH_PRIVKEY:
+                self.__signing = KeyFile(settings.config.AUTH_PRIVKEY, private=True)
+            self.__signing.refresh()
+
+            paths = [settings.config.AUTH_PUBKEY]
+            if settings.config.AUTH_PUBKEYS_PATH:
+                paths += sorted(glob.glob(os.path.join(settings.config.AUTH_PUBKEYS_PATH, '*.pem')))
+
+            files = dict()
+            pubkeys = dict()
+            for path in paths:
+                keyfile = self.__files.get(path) or KeyFile(path)
+                if keyfile.refresh():
+                    files[path] = keyfile
+                    pubkeys[keyfile.kid] = keyfile.key
+            self.__files = files
+            self.__pubkeys = pubkeys
+            self.__next_check = now + settings.config.AUTH_KEY_CHECK_INTERVAL
+
+    def get_signing_key(self):
+        """Get the (kid, private key) used to sign new tokens"""
+        self.__refresh()
+        if not self.__signing or not self.__signing.key:
+            return None, None
+        return self.__signing.kid, self.__signing.key
+
+    def get_verifying_key(self, kid=None):
+        """Get the public key for the kid, or the current public key for tokens without kid"""
+        self.__refresh()
+        if kid:
+            return self.__pubkeys.get(kid)
+        keyfile = self.__files.get(settings.config.AUTH_PUBKEY)
+        return keyfile.key if keyfile else None
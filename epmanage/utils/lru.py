@@ -0,0 +1,84 @@
+"""
+lru.py : In-memory LRU cache
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Bounded, thread-safe, per-process cache with optional expiration (in seconds)"""
+
+    def __init__(self, maxsize=1024, expire=None):
+        self.maxsize = maxsize
+        self.expire = expire
+        self.__lock = threading.Lock()
+        self.__data = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            try:
+                deadline, value = self.__data[key]
+            except KeyError:
+                return default
+            if deadline is not None and deadline <= time.monotonic():
+                del self.__data[key]
+                return default
+            self.__data.move_to_end(key)
+            return value
+
+    def set(self, key, value, expire=None):
+        """Store a value, expire overrides the default expiration"""
+        if expire is None:
+            expire = self.expire
+        deadline = time.monotonic() + expire if expire is not None else None
+        with self.__lock:
+            self.__data[key] = (deadline, value)
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.__lock:
+            item = self.__data.pop(key, None)
+        return item[1] if item else default
+
+    def evict(self, predicate):
+        """Remove every entry for which predicate(key, value) is true"""
+        with self.__lock:
+            keys = [key for key, (_, value) in self.__data.items() if predicate(key, value)]
+            for key in keys:
+                del self.__data[key]
+        return len(keys)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+
+    def keys(self):
+        """Get the keys, expired entries included"""
+        with self.__lock:
+            return list(self.__data.keys())
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self.__data)
@@ -18,15 +18,36 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
+import threading
+
 import eve.io.mongo
+from pymongo import MongoClient
 
 from epmanage.settings import Config
 
+TENANT_PREFIX = 'MONGOCLIENT_'
+POOL_SETTINGS = ['HOST', 'PORT', 'USERNAME', 'PASSWORD', 'AUTH_SOURCE', 'REPLICA_SET']
+
+
+class TenantMongo(object):
+    """Client database on a shared connection pool, same interface as the flask_pymongo objects"""
+
+    def __init__(self, cx: MongoClient, dbname: str):
+        self.cx = cx
+        self.db = cx[dbname]
+
 
 class Mongo(eve.io.mongo.Mongo):
-    """Custom data layer"""
+    """Custom data layer
+
+    Client prefixes (MONGOCLIENT_<token>) do not get their own MongoClient: they share one
+    connection pool per host, port and credentials, and only select their database.
+    """
 
     def __init__(self, app):
+        self.__lock = threading.Lock()
+        self.__pools = dict()
+        self.__tenants = dict()
         super().__init__(app)
 
     def current_mongo_prefix(self, resource=None):
@@ -36,3 +57,55 @@ class Mongo(eve.io.mongo.Mongo):
         else:
             prefix = super().current_mongo_prefix(resource)
         return prefix
+
+    def pymongo(self, resource=None, prefix=None):
+        px = prefix if prefix else self.current_mongo_prefix(resource=resource)
+        if not px.startswith(TENANT_PREFIX):
+            return super().pymongo(resource, px)
+        tenant = self.__tenants.get(px)
+        if not tenant:
+            tenant = self.__get_tenant(px)
+        return tenant
+
+    def invalidate_prefix(self, prefix):
+        """Forget the database of a client prefix, to be called when its settings change"""
+        self.__tenants.pop(prefix, None)
+
+    def __get_setting(self, prefix, name):
+        value = self.app.config.get('{}_{}'.format(prefix, name))
+        if value is None:
+            value = self.app.config.get('MONGO_{}'.format(name))
+        return value
+
+    def __get_tenant(self, prefix):
+        if self.app.config.get('{}_URI'.format(prefix)):
+            return super().pymongo(prefix=prefix)
+
+        settings = tuple(self.__get_setting(prefix, name) for name in POOL_SETTINGS)
+        # Same default database name as flask_pymongo for unknown clients
+        dbname = self.app.config.get('{}_DBNAME'.format(prefix)) or self.app.name
+
+        with self.__lock:
+            pool = self.__pools.get(settings)
+            if not pool:
+                pool = self.__create_pool(*settings)
+                self.__pools[settings] = pool
+            tenant = TenantMongo(pool, dbname)
+            self.__tenants[prefix] = tenant
+        return tenant
+
+    def __create_pool(self, host, port, username, password, auth_source, replica_set):
+        config = self.app.config
+        options = dict(
+            maxPoolSize=config.get('MONGO_POOL_MAX_SIZE'),
+            minPoolSize=config.get('MONGO_POOL_MIN_SIZE'),
+            maxIdleTimeMS=config.get('MONGO_POOL_MAX_IDLE_TIME') * 1000,
+            connect=False,
+        )
+        if username:
+            options.update(username=username, password=password)
+            if auth_source:
+                options['authSource'] = auth_source
+        if replica_set:
+            options['replicaset'] = replica_set
+        return MongoClient(host=host, port=port, **options)
@@ -0,0 +1,73 @@
+"""
+periodic.py : Background periodic jobs
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import atexit
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Periodic(object):
+    """Run a function every interval seconds in a daemon thread
+
+    The thread is started lazily by start(), so that each worker process gets its own
+    after the fork. With at_exit, the function is called one last time on shutdown.
+    """
+
+    def __init__(self, func, interval, at_exit=False):
+        self.func = func
+        self.interval = interval
+        self.at_exit = at_exit
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__pid = None
+
+    def start(self):
+        if self.__thread and self.__pid == os.getpid():
+            return
+        with self.__lock:
+            if self.__thread and self.__pid == os.getpid():
+                return
+            self.__pid = os.getpid()
+            self.__stop.clear()
+            self.__thread = threading.Thread(target=self.__run, name=getattr(self.func, '__name__', 'periodic'))
+            self.__thread.daemon = True
+            self.__thread.start()
+            if self.at_exit:
+                atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the thread and run the function a last time if requested"""
+        self.__stop.set()
+        if self.at_exit:
+            self.__call()
+
+    def __call(self):
+        try:
+            self.func()
+        except Exception:
+            logger.exception("Periodic job %s failed", self.func)
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.__call()